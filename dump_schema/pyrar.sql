@@ -28,9 +28,12 @@ CREATE TABLE `actions` (
   `execute_dt` datetime NOT NULL,
   `action` varchar(50) COLLATE utf8mb4_unicode_ci DEFAULT NULL,
   `created_dt` datetime NOT NULL,
+  `claimed_by` varchar(100) COLLATE utf8mb4_unicode_ci DEFAULT NULL,
+  `claim_expiry_dt` datetime DEFAULT NULL,
   PRIMARY KEY (`action_id`),
   KEY `by_dom` (`domain_id`),
-  KEY `by_date` (`execute_dt`)
+  KEY `by_date` (`execute_dt`),
+  KEY `by_claim` (`claimed_by`)
 ) ENGINE=InnoDB AUTO_INCREMENT=10450 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -47,13 +50,17 @@ CREATE TABLE `backend` (
   `user_id` int(10) unsigned NOT NULL DEFAULT 0,
   `job_type` varchar(50) COLLATE utf8mb4_unicode_ci DEFAULT NULL,
   `failures` int(11) NOT NULL DEFAULT 0,
+  `merged` int(11) NOT NULL DEFAULT 0,
   `num_years` int(11) DEFAULT NULL,
   `authcode` varchar(100) COLLATE utf8mb4_unicode_ci DEFAULT NULL,
+  `claimed_by` varchar(100) COLLATE utf8mb4_unicode_ci DEFAULT NULL,
+  `claim_expiry_dt` datetime DEFAULT NULL,
   `execute_dt` datetime NOT NULL,
   `created_dt` datetime NOT NULL,
   `amended_dt` datetime NOT NULL,
   PRIMARY KEY (`backend_id`),
-  KEY `by_user` (`execute_dt`)
+  KEY `by_user` (`execute_dt`),
+  KEY `by_claim` (`claimed_by`)
 ) ENGINE=InnoDB AUTO_INCREMENT=10450 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
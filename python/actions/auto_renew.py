@@ -0,0 +1,239 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" renew domains that are set to auto-renew, in batches
+
+Domains are priced a registry at a time, then each user is debited once for all the renewals their
+balance covers. Renewals the balance does not cover become orders, for the user to pay for later """
+
+import sys
+import json
+
+from librar.mysql import sql_server as sql
+from librar import mysql, static, misc, registry, domobj, accounts, sales
+from librar.log import log, init as log_init
+from librar.policy import this_policy as policy
+from mailer import spool_email
+from backend import libback, backend_creator
+from actions import make_actions
+
+RENEW_YEARS = 1
+RENEW_STATUS = [static.STATUS_LIVE, static.STATUS_EXPIRED]
+RENEWED_BY = ["dom/renew", "dom/recover"]
+
+
+def price_registry(this_reg, dom_dbs):
+    """ renewal prices of {dom_dbs}, all in {this_reg}, checked `max_checks` names at a time """
+    max_checks = this_reg["max_checks"] if misc.has_data(this_reg, "max_checks") else policy.policy("max_checks")
+    site_currency = policy.policy("currency")
+    prices = {}
+    for start in range(0, len(dom_dbs), max_checks):
+        by_name = {dom_db["name"]: dom_db for dom_db in dom_dbs[start:start + max_checks]}
+        domlist = domobj.DomainList()
+        if not domlist.set_list(list(by_name))[0]:
+            continue
+
+        ok, reply = libback.get_prices(domlist, RENEW_YEARS, ["renew"])
+        if not ok or reply is None:
+            log(f"AUTO-RENEW: Price check failed for {len(by_name)} domains on '{this_reg['name']}'")
+            continue
+        registry.tld_lib.multiply_values(reply, RENEW_YEARS, True)
+
+        for price in reply:
+            if (dom_db := by_name.get(price["name"])) is None or "renew" not in price or "reg_renew" not in price:
+                continue
+            this_dom = domlist.domobjs[price["name"]]
+            this_dom.dom_db = dom_db
+            this_dom.set_locks()
+            if not this_dom.valid_expiry_limit(RENEW_YEARS) or "RenewProhibited" in this_dom.locks:
+                continue
+            prices[dom_db["domain_id"]] = {
+                "price_charged": price["reg_renew"],
+                "price_paid": price["renew"],
+                "currency_charged": domlist.currency["iso"],
+                "currency_paid": site_currency["iso"],
+                "domain_id": dom_db["domain_id"],
+                "user_id": dom_db["user_id"],
+                "order_type": "dom/renew",
+                "num_years": RENEW_YEARS,
+                "authcode": None
+            }
+    return prices
+
+
+def price_domains(dom_dbs):
+    """ renewal order for each of {dom_dbs}, by domain_id """
+    by_reg = {}
+    for dom_db in dom_dbs:
+        if (this_reg := registry.tld_lib.reg_record_for_domain(dom_db["name"])) is not None:
+            by_reg.setdefault(this_reg["name"], (this_reg, []))[1].append(dom_db)
+
+    prices = {}
+    for this_reg, reg_dom_dbs in by_reg.values():
+        prices.update(price_registry(this_reg, reg_dom_dbs))
+    return prices
+
+
+def already_renewed(act_doms, dom_dbs):
+    """ domain_ids of {dom_dbs} sold a renewal since their action was queued, or with one waiting to run """
+    queued = {act_db["domain_id"]: act_db["created_dt"] for act_db, __ in act_doms if act_db["domain_id"] in dom_dbs}
+    where = mysql.data_set({"domain_id": list(dom_dbs), "sales_type": RENEWED_BY}, " and ")
+    ok, reply = sql.sql_select("sales", f"{where} and created_dt >= '{min(queued.values())}'",
+                               columns="domain_id,created_dt")
+    renewed = set()
+    if ok:
+        renewed.update(sale_db["domain_id"] for sale_db in reply
+                       if sale_db["created_dt"] >= queued[sale_db["domain_id"]])
+
+    ok, reply = sql.sql_select("backend", {"domain_id": list(dom_dbs), "job_type": RENEWED_BY}, columns="domain_id")
+    if ok:
+        renewed.update(job_db["domain_id"] for job_db in reply)
+    return renewed
+
+
+def wanted_renewals(act_doms):
+    """ domains still set to auto-renew, without an order already waiting & not already renewed """
+    dom_dbs = {
+        dom_db["domain_id"]: dom_db
+        for __, dom_db in act_doms if dom_db["auto_renew"] and dom_db["status_id"] in RENEW_STATUS
+    }
+    if len(dom_dbs) > 0:
+        ok, reply = sql.sql_select("orders", {"domain_id": list(dom_dbs)}, columns="domain_id")
+        if ok:
+            for order_db in reply:
+                dom_dbs.pop(order_db["domain_id"], None)
+    if len(dom_dbs) > 0:
+        for domain_id in already_renewed(act_doms, dom_dbs):
+            log(f"AUTO-RENEW: DOM-{domain_id} has already been renewed")
+            dom_dbs.pop(domain_id, None)
+    return list(dom_dbs.values())
+
+
+def split_affordable(user_db, dom_dbs, prices):
+    """ soonest to expire first, split {dom_dbs} into those {user_db} can afford & those they can not """
+    can_afford = []
+    cannot_afford = []
+    available = user_db["acct_current_balance"] - user_db["acct_overdraw_limit"]
+    on_hold = user_db["account_closed"] or user_db["acct_on_hold"]
+    for dom_db in sorted(dom_dbs, key=lambda dom_db: dom_db["expiry_dt"]):
+        price_paid = prices[dom_db["domain_id"]]["price_paid"]
+        if not on_hold and price_paid <= available:
+            available -= price_paid
+            can_afford.append(dom_db)
+        else:
+            cannot_afford.append(dom_db)
+    return can_afford, cannot_afford
+
+
+def reverse_debit(user_db, total, trans_id, why):
+    """ something after the debit failed, so remove its sales & give the user their money back """
+    log(f"AUTO-RENEW: {why} for user {user_db['user_id']}, reversing transaction {trans_id}")
+    sql.sql_delete("sales", {"transaction_id": trans_id})
+    ok, reply = accounts.apply_transaction(user_db["user_id"], total, f"Reversal of auto-renew, {why}", as_admin=True)
+    if not ok:
+        log(f"AUTO-RENEW: ERROR: Reversal of {total} for user {user_db['user_id']} failed - {reply}")
+    return False
+
+
+def renew_for_user(user_db, dom_dbs, prices):
+    """ debit {user_db} once for all of {dom_dbs}, record the sales & queue the renewals, all in bulk
+    each step commits on its own, so if a step after the debit fails, the debit is reversed """
+    total = sum(prices[dom_db["domain_id"]]["price_paid"] for dom_db in dom_dbs)
+    ok, trans_id = accounts.apply_transaction(user_db["user_id"], -1 * total,
+                                              f"Auto-renew {len(dom_dbs)} domains for {RENEW_YEARS} yrs")
+    if not ok:
+        log(f"AUTO-RENEW: Debit of {total} failed for user {user_db['user_id']} - {trans_id}")
+        return False
+
+    row_count, __ = sql.sql_insert_many("sales", [{
+        **sales.sale_record(trans_id, prices[dom_db["domain_id"]], dom_db, user_db), "created_dt": None,
+        "amended_dt": None
+    } for dom_db in dom_dbs])
+    if row_count != len(dom_dbs):
+        return reverse_debit(user_db, total, trans_id, "sales not recorded")
+
+    if not backend_creator.make_jobs_for_names("dom/renew", [dom_db["name"] for dom_db in dom_dbs], RENEW_YEARS):
+        return reverse_debit(user_db, total, trans_id, "renewals not queued")
+
+    mysql.event_log_many([{
+        "event_type": "dom/renew",
+        "notes": f"Sale: {dom_db['name']} auto-renewed for {RENEW_YEARS} yrs",
+        "domain_id": dom_db["domain_id"],
+        "user_id": dom_db["user_id"],
+        "who_did_it": "auto-renew",
+        "from_where": "localhost"
+    } for dom_db in dom_dbs])
+
+    ok, sale_dbs = sql.sql_select("sales", {"transaction_id": trans_id}, columns="sales_item_id,domain_id")
+    spool_email.spool_many("receipt", [[["sales", {
+        "sales_item_id": sale_db["sales_item_id"]
+    }], ["domains", {
+        "domain_id": sale_db["domain_id"]
+    }], ["users", {
+        "user_id": user_db["user_id"]
+    }]] for sale_db in (sale_dbs if ok else [])])
+    return True
+
+
+def order_for_user(dom_dbs, prices):
+    """ the user's balance does not cover {dom_dbs}, so make them orders for the user to pay """
+    sql.sql_insert_many("orders", [{
+        **prices[dom_db["domain_id"]], "status": "unpaid",
+        "created_dt": None,
+        "amended_dt": None
+    } for dom_db in dom_dbs])
+
+    for dom_db in dom_dbs:
+        make_actions.recreate(dom_db, "auto-renew")
+    spool_email.spool_many("payment_reminder", [[["users", {
+        "user_id": dom_db["user_id"]
+    }], ["orders", {
+        "domain_id": dom_db["domain_id"]
+    }], ["domains", {
+        "domain_id": dom_db["domain_id"]
+    }]] for dom_db in dom_dbs])
+
+
+def renew_domains(act_doms):
+    """ batch handler for `dom/auto-renew` actions """
+    if len(dom_dbs := wanted_renewals(act_doms)) <= 0:
+        return True
+
+    prices = price_domains(dom_dbs)
+    if len(unpriced := [dom_db for dom_db in dom_dbs if dom_db["domain_id"] not in prices]) > 0:
+        log(f"AUTO-RENEW: No renewal price for DOM-{','.join([str(dom_db['domain_id']) for dom_db in unpriced])}")
+
+    by_user = {}
+    for dom_db in dom_dbs:
+        if dom_db["domain_id"] in prices:
+            by_user.setdefault(dom_db["user_id"], []).append(dom_db)
+    if len(by_user) <= 0:
+        return True
+
+    ok, users = sql.sql_select("users", {"user_id": list(by_user)})
+    if not ok:
+        return False
+
+    counts = {"renewed": 0, "ordered": 0}
+    for user_db in users:
+        can_afford, cannot_afford = split_affordable(user_db, by_user[user_db["user_id"]], prices)
+        if len(can_afford) > 0 and not renew_for_user(user_db, can_afford, prices):
+            cannot_afford += can_afford
+            can_afford = []
+        if len(cannot_afford) > 0:
+            order_for_user(cannot_afford, prices)
+        counts["renewed"] += len(can_afford)
+        counts["ordered"] += len(cannot_afford)
+
+    log(f"AUTO-RENEW: {json.dumps(counts)}")
+    return True
+
+
+if __name__ == "__main__":
+    log_init(with_debug=True)
+    sql.connect("engine")
+    registry.start_up()
+    libback.start_ups()
+    ok, dom_db = sql.sql_select_one("domains", {"name": sys.argv[1]})
+    if ok:
+        print(json.dumps(price_domains([dom_db]), indent=3))
@@ -11,77 +11,157 @@ from librar.mysql import sql_server as sql
 from librar import static
 from librar import misc
 from librar import registry
+from librar import sigprocs
 from librar.log import log, init as log_init
 from librar.policy import this_policy as policy
 
+RECREATE_LOCK_WAIT = 10
 
-def add_domain_action(dom_db, now, when, action):
+
+def lock_name(domain_id):
+    return misc.ashex(f"pyrar.actions.{int(domain_id)}")
+
+
+def lock_domains(domain_ids, wait=0):
+    """ take the DB lock on the actions of each of {domain_ids}, waiting up to {wait} secs, return those we got """
+    got = []
+    for domain_id in domain_ids:
+        ok, reply = sql.run_select(f"select get_lock(unhex('{lock_name(domain_id)}'),{int(wait)}) 'got'")
+        if ok and len(reply) == 1 and reply[0]["got"] == 1:
+            got.append(domain_id)
+    return got
+
+
+def unlock_domains(domain_ids):
+    for domain_id in domain_ids:
+        sql.run_select(f"select release_lock(unhex('{lock_name(domain_id)}')) 'done'")
+
+
+def add_domain_action(sched, now, when, action):
     if when >= now:
-        sql.sql_insert("actions", {"domain_id": dom_db["domain_id"], "execute_dt": when, "action": action})
+        sched.append((when, action))
 
 
-def add_order_reminders(dom_db, now, reminder_sched, reminder_type):
+def get_order(dom_db, orders):
+    """ order for {dom_db}, from {orders} if the caller has loaded them already """
+    if orders is not None:
+        return orders.get(dom_db["domain_id"])
     ok, order_db = sql.sql_select_one("orders", {"domain_id": dom_db["domain_id"]})
-    if not ok or len(order_db) <= 0:
+    return order_db if ok and len(order_db) > 0 else None
+
+
+def add_order_reminders(sched, dom_db, now, reminder_sched, reminder_type, orders=None):
+    if (order_db := get_order(dom_db, orders)) is None:
         return
-    sched = None
+    days_list = None
     if isinstance(reminder_sched, list):
-        sched = reminder_sched
+        days_list = reminder_sched
     elif isinstance(reminder_sched, str):
-        sched = reminder_sched.split(",")
-    if sched is None:
+        days_list = reminder_sched.split(",")
+    if days_list is None:
         raise ValueError(f"Reminder schedule for {reminder_type} has invalid type")
 
-    for days in sched[:-1]:
-        add_domain_action(dom_db, now, misc.date_add(order_db["created_dt"], hours=float(days) * 24), reminder_type)
-    add_domain_action(dom_db, now, misc.date_add(order_db["created_dt"], hours=float(sched[-1]) * 24), "order/cancel")
+    for days in days_list[:-1]:
+        add_domain_action(sched, now, misc.date_add(order_db["created_dt"], hours=float(days) * 24), reminder_type)
+    add_domain_action(sched, now, misc.date_add(order_db["created_dt"], hours=float(days_list[-1]) * 24),
+                      "order/cancel")
 
 
-def domain_actions_live(dom_db, now):
+def domain_actions_live(sched, dom_db, now, orders=None):
     if dom_db["auto_renew"]:
-        add_domain_action(dom_db, now,
+        add_domain_action(sched, now,
                           misc.date_add(dom_db["expiry_dt"], days=-1 * float(policy.policy("auto_renew_before"))),
                           "dom/auto-renew")
     else:
         if (reminders_at := policy.policy("renewal_reminders")) is not None:
             for days in reminders_at.split(","):
-                add_domain_action(dom_db, misc.date_add(dom_db["expiry_dt"], days=-1 * float(days)), "dom/reminder")
+                add_domain_action(sched, now, misc.date_add(dom_db["expiry_dt"], days=-1 * float(days)),
+                                  "dom/reminder")
 
-    add_domain_action(dom_db, now, dom_db["expiry_dt"], "dom/expired")
+    add_domain_action(sched, now, dom_db["expiry_dt"], "dom/expired")
 
     this_reg = registry.tld_lib.reg_record_for_domain(dom_db["name"])
     if this_reg is not None:
-        add_domain_action(dom_db, now, misc.date_add(dom_db["expiry_dt"],
-                                                     days=float(this_reg["expire_recover_limit"])), "dom/delete")
+        add_domain_action(sched, now, misc.date_add(dom_db["expiry_dt"], days=float(this_reg["expire_recover_limit"])),
+                          "dom/delete")
+        add_order_reminders(sched, dom_db, now, this_reg["renew_order_remind_cancel"], "order/reminder", orders)
 
-    add_order_reminders(dom_db, now, this_reg["renew_order_remind_cancel"], "order/reminder")
 
-
-def domain_actions_pending_order(dom_db, now):
+def domain_actions_pending_order(sched, dom_db, now, orders=None):
     if (this_reg := registry.tld_lib.reg_record_for_domain(dom_db["name"])) is None:
         return
-    add_order_reminders(dom_db, now, this_reg["new_order_remind_cancel"], "order/reminder")
+    add_order_reminders(sched, dom_db, now, this_reg["new_order_remind_cancel"], "order/reminder", orders)
+
+
+def wanted_actions(dom_db, now, orders=None):
+    """ the schedule of actions {dom_db} should have, as a list of (execute_dt, action) """
+    sched = []
+    if dom_db["status_id"] in action_fns:
+        action_fns[dom_db["status_id"]](sched, dom_db, now, orders)
+    else:
+        log(f"WARNINNG: No domain action recreate for domain status {dom_db['status_id']}")
+    return sched
+
+
+def diff_actions(have_rows, sched):
+    """ return the `action_id`s of {have_rows} not in {sched} & the items of {sched} not in {have_rows} """
+    want = {}
+    for item in sched:
+        want[item] = want.get(item, 0) + 1
+
+    delete_ids = []
+    for row in have_rows:
+        if want.get(key := (row["execute_dt"], row["action"]), 0) > 0:
+            want[key] -= 1
+        else:
+            delete_ids.append(row["action_id"])
+
+    return delete_ids, [item for item, count in want.items() for __ in range(count)]
 
 
 def recreate(dom_db, who_did_it="sales"):
+    """ bring the domain's actions into line with its schedule, return number of rows changed """
+    locked = lock_domains([dom_db["domain_id"]], RECREATE_LOCK_WAIT)
+    if len(locked) <= 0:
+        log(f"Actions lock for DOM-{dom_db['domain_id']} not free after {RECREATE_LOCK_WAIT}s, recreating anyway")
+    try:
+        return recreate_locked(dom_db, who_did_it)
+    finally:
+        unlock_domains(locked)
+
+
+def recreate_locked(dom_db, who_did_it):
+    sched = wanted_actions(dom_db, misc.now())
+
+    ok, have_rows = sql.sql_select("actions", {"domain_id": dom_db["domain_id"]},
+                                   columns="action_id,execute_dt,action")
+    if not ok:
+        return None
+    delete_ids, inserts = diff_actions(have_rows, sched)
+
+    if len(delete_ids) > 0:
+        sql.sql_delete("actions", {"action_id": delete_ids})
+    if len(inserts) > 0:
+        sql.sql_insert_many("actions", [{
+            "domain_id": dom_db["domain_id"],
+            "execute_dt": when,
+            "action": action,
+            "created_dt": None
+        } for when, action in inserts])
+        sigprocs.signal_service("actions")
+
     mysql.event_log(
         {
             "event_type": "actions/recreate",
-            "notes": f"Recreate domain actions for '{dom_db['name']}', Exp {dom_db['expiry_dt'].split()[0]}",
+            "notes": f"Recreate domain actions for '{dom_db['name']}', Exp {dom_db['expiry_dt'].split()[0]}" +
+            f", {len(inserts)} added, {len(delete_ids)} removed, {len(sched) - len(inserts)} unchanged",
             "domain_id": dom_db["domain_id"],
             "user_id": dom_db["user_id"],
             "who_did_it": who_did_it,
             "from_where": "localhost"
         }, 1)
 
-    sql.sql_delete("actions", {"domain_id": dom_db["domain_id"]})
-
-    now = misc.now()
-    if dom_db["status_id"] in action_fns:
-        return action_fns[dom_db["status_id"]](dom_db, now)
-
-    log(f"WARNINNG: No domain action recreate for domain status {dom_db['status_id']}")
-    return True
+    return len(inserts) + len(delete_ids)
 
 
 action_fns = {
@@ -98,7 +178,7 @@ def main():
 
     ok, dom_db = sql.sql_select_one("domains", {"name": sys.argv[1]})
     if ok and len(dom_db) > 0:
-        recreate(dom_db)
+        print(">>>> CHANGED", recreate(dom_db))
         ok, reply = sql.sql_select("actions", {"domain_id": dom_db["domain_id"]}, order_by="execute_dt")
         print(json.dumps(dom_db, indent=3))
         print(json.dumps(reply, indent=3))
@@ -0,0 +1,241 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" rebuild the actions of every domain, after the policy or registry schedules have changed
+
+Domains are read in chunks, with their orders & current actions. Those that differ are locked & read again,
+so a live recreate is not undone, then only the rows that differ are changed, in bulk. Progress is saved
+after each chunk, so a stopped rebuild carries on where it got to """
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from librar.mysql import sql_server as sql
+from librar import registry, static, misc, mysql, sigprocs
+from librar.log import log, init as log_init
+from librar.policy import this_policy as policy
+from actions import make_actions
+
+REBUILD_BASE = f"{os.environ['BASE']}/storage/perm/actions"
+CHECKPOINT_FILE = f"{REBUILD_BASE}/rebuild_checkpoint.json"
+
+REBUILD_STATUS = [static.STATUS_LIVE, static.STATUS_EXPIRED, static.STATUS_WAITING_PAYMENT]
+
+
+def load_checkpoint():
+    if not os.path.isfile(CHECKPOINT_FILE):
+        return 0
+    with open(CHECKPOINT_FILE, "r", encoding="utf-8") as fd:
+        return json.load(fd).get("after_id", 0)
+
+
+def save_checkpoint(after_id):
+    tmp_file = CHECKPOINT_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as fd:
+        json.dump({"after_id": after_id, "when_dt": misc.now()}, fd)
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+
+def by_domain_id(rows):
+    ret = {}
+    for row in rows:
+        ret.setdefault(row["domain_id"], []).append(row)
+    return ret
+
+
+class Rebuilder:
+    """ bring the actions of a chunk of domains at a time into line with their schedules """
+    def __init__(self, status_list, reg_name=None, dry_run=False):
+        self.dry_run = dry_run
+        self.where = "status_id in (" + ",".join([str(int(status_id)) for status_id in status_list]) + ")"
+        if reg_name is not None:
+            if (by_name := registry.tld_lib.name_in_registry_sql(reg_name)) is None:
+                raise ValueError(f"Registry '{reg_name}' has no TLDs")
+            self.where += f" and {by_name}"
+        self.counts = {"domains": 0, "changed": 0, "added": 0, "removed": 0, "unchanged": 0, "busy": 0}
+        self.by_action = {}
+        self.failed = False
+
+    def count_action(self, action, what):
+        if action not in self.by_action:
+            self.by_action[action] = {"added": 0, "removed": 0}
+        self.by_action[action][what] += 1
+
+    def load_diffs(self, dom_dbs):
+        """ {domain_id: (rows, schedule, deletes, inserts)} to bring {dom_dbs} into line, None if a read failed """
+        dom_ids = [dom_db["domain_id"] for dom_db in dom_dbs]
+        ok_ord, order_rows = sql.sql_select("orders", {"domain_id": dom_ids})
+        ok_act, action_rows = sql.sql_select("actions", {"domain_id": dom_ids},
+                                             columns="action_id,domain_id,execute_dt,action")
+        if not ok_ord or not ok_act:
+            return None
+
+        orders = {}
+        for order_db in order_rows:
+            orders.setdefault(order_db["domain_id"], order_db)
+        have_actions = by_domain_id(action_rows)
+        now = misc.now()
+
+        diffs = {}
+        for dom_db in dom_dbs:
+            have_rows = have_actions.get(dom_db["domain_id"], [])
+            sched = make_actions.wanted_actions(dom_db, now, orders)
+            diffs[dom_db["domain_id"]] = (have_rows, sched) + make_actions.diff_actions(have_rows, sched)
+        return diffs
+
+    def reload_changed(self, diffs):
+        """ a live recreate may have changed a domain since we read it, so lock those we would change & read
+        them again, return the domain_ids locked & their new diffs, those we could not lock are left to it """
+        changed = [domain_id for domain_id, (__, __, deletes, inserts) in diffs.items() if deletes or inserts]
+        if len(changed) <= 0:
+            return [], {}
+
+        locked = make_actions.lock_domains(changed)
+        self.counts["busy"] += len(changed) - len(locked)
+        if len(locked) <= 0:
+            return locked, {}
+        ok, dom_dbs = sql.sql_select("domains", mysql.data_set({"domain_id": locked}, " and ") + f" and {self.where}")
+        return locked, (self.load_diffs(dom_dbs) if ok else None)
+
+    def run_chunk(self, dom_dbs):
+        """ diff the actions of {dom_dbs} against their schedules, apply the differences """
+        if (diffs := self.load_diffs(dom_dbs)) is None:
+            return False
+        if self.dry_run:
+            self.count_diffs(diffs)
+            return True
+
+        locked = []
+        try:
+            locked, changed_diffs = self.reload_changed(diffs)
+            if changed_diffs is None:
+                return False
+            self.count_diffs({
+                domain_id: diff
+                for domain_id, diff in diffs.items() if len(diff[2]) <= 0 and len(diff[3]) <= 0
+            })
+            return self.apply_diffs(self.count_diffs(changed_diffs))
+        finally:
+            make_actions.unlock_domains(locked)
+
+    def count_diffs(self, diffs):
+        self.counts["domains"] += len(diffs)
+        for have_rows, sched, dom_deletes, dom_inserts in diffs.values():
+            self.counts["unchanged"] += len(sched) - len(dom_inserts)
+            if len(dom_deletes) <= 0 and len(dom_inserts) <= 0:
+                continue
+            self.counts["changed"] += 1
+            self.counts["added"] += len(dom_inserts)
+            self.counts["removed"] += len(dom_deletes)
+
+            removed = set(dom_deletes)
+            for row in have_rows:
+                if row["action_id"] in removed:
+                    self.count_action(row["action"], "removed")
+            for __, action in dom_inserts:
+                self.count_action(action, "added")
+        return diffs
+
+    def apply_diffs(self, diffs):
+        """ delete & insert the action rows of {diffs}, all in bulk & in one transaction """
+        delete_ids = []
+        inserts = []
+        for domain_id, (__, __, dom_deletes, dom_inserts) in diffs.items():
+            delete_ids += dom_deletes
+            inserts += [{
+                "domain_id": domain_id,
+                "execute_dt": when,
+                "action": action,
+                "created_dt": None
+            } for when, action in dom_inserts]
+
+        # one transaction, so a domain is never left with its old actions deleted but the new ones not added
+        sqls = []
+        if len(delete_ids) > 0:
+            sqls.append("delete from actions where " + mysql.data_set({"action_id": delete_ids}, " and "))
+        if len(inserts) > 0:
+            sqls.append(mysql.insert_many_sql("actions", inserts))
+        if len(sqls) <= 0:
+            return True
+        if not sql.sql_transaction(sqls):
+            return False
+        if len(inserts) > 0:
+            sigprocs.signal_service("actions")
+        return True
+
+    def rebuild(self, after_id, max_domains=None, pause=0):
+        """ rebuild from domain {after_id}, sleeping {pause} secs between chunks, return where we got to,
+        which is `0` once every domain is done, unless `failed` is set """
+        chunk_size = policy.policy("actions_rebuild_chunk")
+        while max_domains is None or self.counts["domains"] < max_domains:
+            ok, dom_dbs = sql.sql_select("domains", f"domain_id > {int(after_id)} and {self.where}",
+                                         limit=chunk_size,
+                                         order_by="domain_id")
+            if not ok:
+                log(f"ERROR: Rebuild of actions could not read domains after DOM-{after_id}")
+                self.failed = True
+                return after_id
+            if len(dom_dbs) <= 0:
+                return 0
+            if not self.run_chunk(dom_dbs):
+                log(f"ERROR: Rebuild of actions failed after DOM-{after_id}")
+                self.failed = True
+                return after_id
+
+            after_id = dom_dbs[-1]["domain_id"]
+            if not self.dry_run:
+                save_checkpoint(after_id)
+            if pause > 0:
+                time.sleep(pause)
+
+        return after_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild all domain actions')
+    parser.add_argument("-D", '--debug', action="store_true")
+    parser.add_argument("-n", '--dry-run', action="store_true", help="Only report what would change")
+    parser.add_argument("-r", '--registry', help="Only rebuild domains of this registry")
+    parser.add_argument("-s", '--status', help="Only rebuild domains with these status_id, comma separated")
+    parser.add_argument("-m", '--max-domains', type=int, help="Stop after this many domains")
+    parser.add_argument("-p", '--pause', type=float, default=0.1, help="Seconds to sleep between chunks")
+    parser.add_argument("-R", '--restart', action="store_true", help="Ignore the checkpoint, start again")
+    args = parser.parse_args()
+    log_init(with_debug=args.debug)
+
+    sql.connect("engine")
+    registry.start_up()
+
+    status_list = [int(status_id) for status_id in args.status.split(",")] if args.status else REBUILD_STATUS
+    rebuilder = Rebuilder(status_list, args.registry, args.dry_run)
+
+    if not args.dry_run and not os.path.isdir(REBUILD_BASE):
+        os.mkdir(REBUILD_BASE)
+    after_id = 0 if args.restart or args.dry_run else load_checkpoint()
+
+    after_id = rebuilder.rebuild(after_id, args.max_domains, args.pause)
+    if not args.dry_run:
+        save_checkpoint(after_id)
+
+    notes = (f"Rebuild actions{' (dry run)' if args.dry_run else ''}: {json.dumps(rebuilder.counts)}, " +
+             ("complete" if after_id == 0 and not rebuilder.failed else f"stopped at DOM-{after_id}"))
+    log(notes)
+    if not args.dry_run:
+        mysql.event_log({
+            "event_type": "actions/rebuild",
+            "notes": notes,
+            "domain_id": None,
+            "user_id": None,
+            "who_did_it": "rebuild",
+            "from_where": "localhost"
+        }, 1)
+
+    print(json.dumps({"counts": rebuilder.counts, "by_action": rebuilder.by_action, "after_id": after_id}, indent=3))
+    sys.exit(1 if rebuilder.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,23 @@
 # Alternative license arrangements possible, contact me for more information
 """ Run waiting domain actions when time is ready """
 
+import os
 import sys
+import time
+import heapq
+import itertools
+import socket
 import argparse
+import datetime
 
 from librar import static, misc, registry, pdns, mysql
 from librar.mysql import sql_server as sql
 from librar.log import log, debug, init as log_init
+from librar.policy import this_policy as policy
+from librar import sigprocs
 from mailer import spool_email
 from backend import backend_creator
+from actions import auto_renew
 
 COPY_DEL_DOM_COLS = [
     "domain_id", "name", "user_id", "status_id", "auto_renew", "ns", "ds", "client_locks", "created_dt", "amended_dt",
@@ -18,15 +27,18 @@ COPY_DEL_DOM_COLS = [
 ]
 
 
-def event_log(notes, action):
-    mysql.event_log({
+ACTION_COLS = ["action_id", "domain_id", "action", "execute_dt", "created_dt"]
+
+
+def event_item(notes, action):
+    return {
         "event_type": "Action:" + action["action"],
         "domain_id": action["domain_id"],
         "user_id": None,
         "who_did_it": "action",
         "from_where": "localhost",
         "notes": notes
-    })
+    }
 
 
 def flag_expired_domain(__, dom_db):
@@ -35,6 +47,14 @@ def flag_expired_domain(__, dom_db):
     return backend_creator.make_job("dom/expired", dom_db)
 
 
+def flag_expired_domains(act_doms):
+    """ batch version of `flag_expired_domain` """
+    pdns.catalog_update(del_names=[dom_db["name"] for __, dom_db in act_doms])
+    sql.sql_update("domains", {"status_id": static.STATUS_EXPIRED, "amended_dt": None},
+                   {"domain_id": [dom_db["domain_id"] for __, dom_db in act_doms]})
+    return backend_creator.make_jobs_for_names("dom/expired", [dom_db["name"] for __, dom_db in act_doms])
+
+
 def order_cancel(act_db, dom_db):
     ok, order_db = sql.sql_select_one("orders", {"domain_id": dom_db["domain_id"], "user_id": dom_db["user_id"]})
     if not ok or len(order_db) <= 0:
@@ -60,27 +80,98 @@ def delete_domain(__, dom_db):
 
 
 def send_order_reminder(act_db, dom_db):
-    spool_email.spool("payment_reminder", [["users", {
+    spool_email.spool("payment_reminder", order_reminder_request(dom_db))
+    return True
+
+
+def auto_renew_domain(act_db, dom_db):
+    return auto_renew.renew_domains([(act_db, dom_db)])
+
+
+def order_reminder_request(dom_db):
+    return [["users", {
         "user_id": dom_db["user_id"]
     }], ["orders", {
         "domain_id": dom_db["domain_id"]
     }], ["domains", {
         "domain_id": dom_db["domain_id"]
-    }]])
+    }]]
+
+
+def digests_wanted():
+    return policy.policy("reminder_digest_window") > 0
+
+
+def user_reminders(act_doms):
+    """ {act_doms} by user, each domain once, soonest to expire first """
+    by_user = {}
+    for __, dom_db in act_doms:
+        by_user.setdefault(dom_db["user_id"], {})[dom_db["domain_id"]] = dom_db
+    return {
+        user_id: sorted(dom_dbs.values(), key=lambda dom_db: dom_db["expiry_dt"])
+        for user_id, dom_dbs in by_user.items()
+    }
+
+
+def digest_item(dom_db, order_db=None):
+    """ one domain listed in a digest email """
+    item = {
+        "domain": spool_email.format_record("domains", dict(dom_db)),
+        "registry": registry.tld_lib.reg_record_for_domain(dom_db["name"])
+    }
+    if order_db is not None:
+        item["order"] = spool_email.format_record("orders", order_db)
+    return item
+
+
+def digest_request(user_id, items):
+    return [["users", {"user_id": user_id}], [None, {"items": items}]]
+
+
+def send_order_reminders(act_doms):
+    """ batch version of `send_order_reminder`, users with many unpaid orders get one digest email """
+    singles = []
+    digests = []
+    for user_id, dom_dbs in user_reminders(act_doms).items():
+        if len(dom_dbs) == 1 or not digests_wanted():
+            singles += [order_reminder_request(dom_db) for dom_db in dom_dbs]
+            continue
+        ok, reply = sql.sql_select("orders", {"domain_id": [dom_db["domain_id"] for dom_db in dom_dbs]})
+        orders = {order_db["domain_id"]: order_db for order_db in reply} if ok else {}
+        if len(items := [digest_item(dom_db, orders[dom_db["domain_id"]])
+                         for dom_db in dom_dbs if dom_db["domain_id"] in orders]) > 0:
+            digests.append(digest_request(user_id, items))
+
+    spool_email.spool_many("payment_reminder", singles)
+    spool_email.spool_many("payment_reminder_digest", digests)
     return True
 
 
-def auto_renew_domain(act_db, dom_db):
-    # CODE REQUIRED
+def expiry_reminder_request(dom_db):
+    return [["users", {
+        "user_id": dom_db["user_id"]
+    }], ["domains", {
+        "domain_id": dom_db["domain_id"]
+    }]]
+
+
+def send_expiry_reminders(act_doms):
+    """ batch version of `send_expiry_reminder`, users with many domains expiring get one digest email """
+    singles = []
+    digests = []
+    for user_id, dom_dbs in user_reminders(act_doms).items():
+        if len(dom_dbs) == 1 or not digests_wanted():
+            singles += [expiry_reminder_request(dom_db) for dom_db in dom_dbs]
+        else:
+            digests.append(digest_request(user_id, [digest_item(dom_db) for dom_db in dom_dbs]))
+
+    spool_email.spool_many("reminder", singles)
+    spool_email.spool_many("reminder_digest", digests)
     return True
 
 
 def send_expiry_reminder(__, dom_db):
-    spool_email.spool("reminder", [["users", {
-        "user_id": dom_db["user_id"]
-    }], ["domains", {
-        "domain_id": dom_db["domain_id"]
-    }]])
+    spool_email.spool("reminder", expiry_reminder_request(dom_db))
     return True
 
 
@@ -97,27 +188,208 @@ action_exec = {
     "order/cancel": order_cancel
 }
 
+action_batch_exec = {
+    "dom/expired": flag_expired_domains,
+    "dom/auto-renew": auto_renew.renew_domains,
+    "dom/reminder": send_expiry_reminders,
+    "order/reminder": send_order_reminders
+}
 
-def runner():
-    ok, act_data = sql.sql_select("actions", "execute_dt < now()", limit=1, order_by="execute_dt")
-    if not ok or not act_data or len(act_data) < 1:
-        return False
+# actions that can remove the domain, so later actions for it in the same batch must be skipped
+DOMAIN_REMOVED_BY = ["dom/delete", "order/cancel"]
+
+# reminders that can be sent early, so a user gets one digest instead of an email per domain
+REMINDER_ACTIONS = ["dom/reminder", "order/reminder"]
+
+
+BATCH_SEQ = itertools.count(1)
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def batch_claim_id():
+    """ a new claim id for each batch, so rows left claimed by an earlier batch are not picked up again """
+    return f"{worker_id()}:{next(BATCH_SEQ)}"
 
-    act_db = act_data[0]
-    if act_db["action"] not in action_exec:
-        log(f"ERROR: Domain action '{act_db['action']}' for DOM-{act_db['domain_id']} - action not found")
-        return delete_action(act_db)
 
-    ok, dom_db = sql.sql_select_one("domains", {"domain_id": act_db["domain_id"]})
-    if not ok or len(dom_db) < 1:
-        log(f"ERROR: Domain action '{act_db['action']}' for DOM-{act_db['domain_id']} - domain not found")
-        return delete_action(act_db)
+def claimed_actions(me):
+    """ actions leased to the batch claim {me}, joined to their domains """
+    ok, reply = sql.run_select(
+        "select actions.action_id 'act_action_id',actions.domain_id 'act_domain_id',actions.action 'act_action'," +
+        "actions.execute_dt 'act_execute_dt',actions.created_dt 'act_created_dt',domains.*" +
+        " from actions left join domains using(domain_id)" +
+        f" where actions.claimed_by=unhex('{me}') order by actions.execute_dt")
+    if not ok:
+        return []
 
+    act_doms = []
+    for row in reply:
+        act_db = {col: row["act_" + col] for col in ACTION_COLS}
+        dom_db = {col: val for col, val in row.items() if col[:4] != "act_"}
+        act_doms.append((act_db, dom_db if dom_db["domain_id"] is not None else None))
+    return act_doms
+
+
+def claim_digest_reminders(me, act_doms):
+    """ also lease reminders due within `reminder_digest_window` to users with a reminder in {act_doms} """
+    user_ids = {
+        int(dom_db["user_id"])
+        for act_db, dom_db in act_doms if dom_db is not None and act_db["action"] in REMINDER_ACTIONS
+    }
+    if len(user_ids) <= 0 or not digests_wanted():
+        return False
+
+    in_actions = ",".join([f"'{action}'" for action in REMINDER_ACTIONS])
+    row_count, __ = sql.sql_exec(
+        f"update actions join domains using(domain_id) set actions.claimed_by=unhex('{me}')," +
+        f"actions.claim_expiry_dt=date_add(now(),interval {int(policy.policy('actions_claim_lease'))} second)" +
+        f" where actions.action in ({in_actions})" +
+        f" and actions.execute_dt < date_add(now(),interval {int(policy.policy('reminder_digest_window'))} second)" +
+        " and (actions.claimed_by is NULL or actions.claim_expiry_dt < now())" +
+        f" and domains.user_id in ({','.join([str(user_id) for user_id in user_ids])})")
+    return bool(row_count)
+
+
+def claim_actions():
+    """ lease a batch of due actions to us, return them joined to their domains """
+    me = misc.ashex(batch_claim_id())
+    query = (f"update actions set claimed_by=unhex('{me}')," +
+             f"claim_expiry_dt=date_add(now(),interval {int(policy.policy('actions_claim_lease'))} second)" +
+             " where execute_dt < now() and (claimed_by is NULL or claim_expiry_dt < now())" +
+             f" order by execute_dt limit {int(policy.policy('actions_batch'))}")
+    row_count, __ = sql.sql_exec(query)
+    if not row_count:
+        return []
+
+    act_doms = claimed_actions(me)
+    if claim_digest_reminders(me, act_doms):
+        act_doms = claimed_actions(me)
+    return act_doms
+
+
+def run_one(act_db, dom_db):
+    """ run one action, return the notes for its event """
     if not action_exec[act_db["action"]](act_db, dom_db):
         log(f"ERROR: Domain action '{act_db['action']}' for DOM-{dom_db['domain_id']} - action failed")
+    return f"Domain action '{act_db['action']}' for DOM-{dom_db['domain_id']} - action done"
+
+
+def finish_actions(act_doms, notes=None):
+    """ delete {act_doms}, logging {notes} for each one, or just delete them if {notes} is None """
+    if len(act_doms) <= 0:
+        return
+    if notes is not None:
+        mysql.event_log_many([event_item(note, act_db) for note, (act_db, __) in zip(notes, act_doms)])
+    sql.sql_delete("actions", {"action_id": [act_db["action_id"] for act_db, __ in act_doms]})
+
+
+def run_group(action, act_doms, removed):
+    """ run {act_doms}, all for {action}, finishing each one as soon as it has run """
+    if action in action_batch_exec:
+        if not action_batch_exec[action](act_doms):
+            log(f"ERROR: Domain action '{action}' for {len(act_doms)} domains - action failed")
+        finish_actions(act_doms, [f"Domain action '{action}' for DOM-{dom_db['domain_id']} - action done"
+                                  for __, dom_db in act_doms])
+        return
+
+    for act_db, dom_db in act_doms:
+        finish_actions([(act_db, dom_db)], [run_one(act_db, dom_db)])
+        if action in DOMAIN_REMOVED_BY and not sql.sql_exists("domains", {"domain_id": dom_db["domain_id"]}):
+            removed.add(dom_db["domain_id"])
+
+
+def run_batch(act_doms):
+    """ run a batch of claimed actions, grouped by type, each group is logged & deleted once it has run
+    if a group fails, what it had not finished stays claimed by this batch & is only retried, by a later batch,
+    once the lease runs out """
+    by_action = {}
+    not_run = []
+    for act_db, dom_db in act_doms:
+        if act_db["action"] not in action_exec:
+            log(f"ERROR: Domain action '{act_db['action']}' for DOM-{act_db['domain_id']} - action not found")
+            not_run.append((act_db, dom_db))
+        elif dom_db is None:
+            log(f"ERROR: Domain action '{act_db['action']}' for DOM-{act_db['domain_id']} - domain not found")
+            not_run.append((act_db, dom_db))
+        else:
+            by_action.setdefault(act_db["action"], []).append((act_db, dom_db))
+    finish_actions(not_run)
+
+    removed = set()
+    for action, this_act_doms in by_action.items():
+        skipped = [(act_db, dom_db) for act_db, dom_db in this_act_doms if dom_db["domain_id"] in removed]
+        finish_actions(skipped)
+        this_act_doms = [(act_db, dom_db) for act_db, dom_db in this_act_doms if dom_db["domain_id"] not in removed]
+        try:
+            run_group(action, this_act_doms, removed)
+        except Exception as exc:
+            log(f"ERROR: Domain action '{action}' for {len(this_act_doms)} domains - {exc}")
+    return True
 
-    event_log(f"Domain action '{act_db['action']}' for DOM-{dom_db['domain_id']} - action done", act_db)
-    return delete_action(act_db)
+
+def runner():
+    """ run one batch of due actions, return False when there are none left """
+    if len(act_doms := claim_actions()) <= 0:
+        return False
+    debug(f"Running {len(act_doms)} actions")
+    return run_batch(act_doms)
+
+
+def as_unix_time(mysql_time):
+    return datetime.datetime.strptime(mysql_time, "%Y-%m-%d %H:%M:%S").timestamp()
+
+
+class DueTimes:
+    """ min-heap of when waiting actions are due, loaded `actions_lookahead` seconds ahead at a time """
+    def __init__(self):
+        self.heap = []
+        self.loaded_until = 0
+
+    def reload(self):
+        lookahead = int(policy.policy("actions_lookahead"))
+        limit = int(policy.policy("actions_batch"))
+        ok, reply = sql.run_select("select distinct execute_dt from actions where claimed_by is NULL" +
+                                   f" and execute_dt < date_add(now(),interval {lookahead} second)" +
+                                   f" order by execute_dt limit {limit}")
+        self.heap = [as_unix_time(row["execute_dt"]) for row in reply] if ok else []
+        heapq.heapify(self.heap)
+        if len(self.heap) >= limit:
+            self.loaded_until = max(self.heap)
+        else:
+            self.loaded_until = time.time() + lookahead
+
+    def next_wake(self):
+        """ when the next batch of actions is due, allowing `actions_coalesce` secs for others to come due """
+        now = time.time()
+        while len(self.heap) > 0 and self.heap[0] < now:
+            heapq.heappop(self.heap)
+        if len(self.heap) <= 0 and now >= self.loaded_until:
+            self.reload()
+
+        # `execute_dt < now()` is used to claim, so wake a second after it's due
+        wake_at = self.heap[0] + 1 + policy.policy("actions_coalesce") if len(self.heap) > 0 else self.loaded_until
+        return min(wake_at, now + policy.policy("actions_max_sleep"))
+
+
+def run_server():
+    """ run actions as they come due, woken early if `make_actions` adds an earlier one """
+    log("ACTIONS SERVER RUNNING")
+    waiter = sigprocs.SignalWaiter("actions")
+    due_times = DueTimes()
+    due_times.reload()
+    signal_mtime = None
+    while True:
+        while runner():
+            pass
+
+        sleep_for = max(due_times.next_wake() - time.time(), 0)
+        signalled, signal_mtime = waiter.wait(signal_mtime, timeout=sleep_for, loop_time=5)
+        if signalled:
+            due_times.reload()
+        if registry.tld_lib.check_for_new_files():
+            pdns.start_up()
 
 
 def main():
@@ -125,6 +397,7 @@ def main():
     parser.add_argument("-D", '--debug', action="store_true")
     parser.add_argument("-a", '--action')
     parser.add_argument("-d", '--domain')
+    parser.add_argument("-s", '--server', action="store_true", help="Keep running, run actions when they are due")
     args = parser.parse_args()
     log_init(with_debug=(args.debug or args.action or args.domain))
 
@@ -142,11 +415,19 @@ def main():
             debug(f"ERROR: action '{args.action}' not possible")
             sys.exit(1)
 
-        act_db = {"domain_id": dom_db["domain_id"], "execute_dt": misc.now(), "action": args.action}
+        act_db = {
+            "domain_id": dom_db["domain_id"],
+            "execute_dt": misc.now(),
+            "created_dt": misc.now(),
+            "action": args.action
+        }
         print(">>>> RUNNING", args.action, "on", dom_db["name"])
         print(">>>> ACTION", action_exec[args.action](act_db, dom_db))
         sys.exit(0)
 
+    if args.server:
+        run_server()
+
     debug("RUNNING")
     while runner():
         pass
@@ -5,10 +5,25 @@
 
 from librar import sigprocs
 from librar import misc
+from librar import mysql
 from librar.mysql import sql_server as sql
 
+# jobs that sync the registry to the database, so one pending job covers any number of requests
+COALESCE_JOBS = {"dom/update": True, "dom/flags": True}
+
+
+def merge_job(job_type, dom_db):
+    """ fold a new {job_type} request for {dom_db} into an identical job not yet attempted """
+    where = mysql.data_set({"domain_id": dom_db["domain_id"], "job_type": job_type, "claimed_by": None}, " and ")
+    query = f"update backend set merged=merged+1 where {where} and failures=0 limit 1"
+    row_count, __ = sql.sql_exec(query)
+    return row_count == 1
+
 
 def make_job(job_type, dom_db, num_years=None, authcode=None):
+    if job_type in COALESCE_JOBS and merge_job(job_type, dom_db):
+        return True
+
     backend_db = {
         "domain_id": dom_db["domain_id"],
         "user_id": dom_db["user_id"],
@@ -16,6 +31,7 @@ def make_job(job_type, dom_db, num_years=None, authcode=None):
         "authcode": authcode,
         "job_type": job_type,
         "failures": 0,
+        "merged": 0,
         "execute_dt": misc.now(),
         "created_dt": None,
         "amended_dt": None
@@ -24,3 +40,19 @@ def make_job(job_type, dom_db, num_years=None, authcode=None):
     ok = sql.sql_insert("backend", backend_db)
     sigprocs.signal_service("backend")
     return ok
+
+
+def make_jobs_for_names(job_type, names, num_years=None):
+    """ queue a {job_type} job for every domain listed in {names} with one insert """
+    if len(names) <= 0:
+        return True
+
+    name_list = mysql.data_set({"name": names}, " and ")
+    years = int(num_years) if num_years is not None else "NULL"
+    query = ("insert into backend (domain_id,user_id,job_type,num_years,failures,execute_dt,created_dt,amended_dt) " +
+             f"select domain_id,user_id,unhex('{misc.ashex(job_type)}'),{years},0,now(),now(),now() " +
+             f"from domains where {name_list}")
+    row_count, __ = sql.sql_exec(query)
+    if row_count:
+        sigprocs.signal_service("backend")
+    return bool(row_count)
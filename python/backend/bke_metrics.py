@@ -0,0 +1,228 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" live metrics for the backend runner, written in the Prometheus text format for a `textfile` collector
+
+Each worker writes its own counters & latencies to `backend_<worker>.prom`, whichever worker
+gets the DB lock also writes the queue state, which all workers share, to `backend_queue.prom`. Alerts are
+worked out from the counts in all the workers' files & compared to the last `backend_queue.prom` """
+
+import os
+import re
+import time
+import collections
+
+from librar.mysql import sql_server as sql
+from librar import registry, misc
+from librar.log import log
+from librar.policy import this_policy as policy
+
+METRICS_DIR = f"{os.environ['BASE']}/storage/shared/metrics"
+QUEUE_LOCK = misc.ashex("pyrar.bke.metrics")
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+RESULTS = ["completed", "retried", "aborted", "postponed"]
+STALE_SECS = 600
+QUEUE_FILE = "backend_queue.prom"
+LABELS_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def label_str(labels):
+    return "{" + ",".join([f'{tag}="{val}"' for tag, val in labels.items()]) + "}" if labels else ""
+
+
+def family(name, kind, help_text, samples):
+    """ one metric family, {samples} being (labels, value) pairs, under its HELP & TYPE """
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"
+            ] + [f"{name}{label_str(labels)} {value}" for labels, value in samples]
+
+
+def read_samples(path, name):
+    """ [(labels, value)] of metric {name} in the metrics file {path} """
+    samples = []
+    try:
+        with open(path, "r", encoding="utf-8") as fd:
+            for line in fd:
+                if line.startswith(name + "{") or line.startswith(name + " "):
+                    labels, __, value = line.rstrip().rpartition(" ")
+                    samples.append((dict(LABELS_RE.findall(labels[len(name):])), float(value)))
+    except (OSError, ValueError):
+        pass
+    return samples
+
+
+class Histogram:
+    """ cumulative latency buckets, as Prometheus expects them """
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, secs):
+        self.count += 1
+        self.total += secs
+        for idx, upper in enumerate(LATENCY_BUCKETS):
+            if secs <= upper:
+                self.buckets[idx] += 1
+        self.buckets[-1] += 1
+
+    def lines(self, name, labels):
+        out = []
+        for upper, count in zip([str(upper) for upper in LATENCY_BUCKETS] + ["+Inf"], self.buckets):
+            out.append(f"{name}_bucket{label_str({**labels, 'le': upper})} {count}")
+        out.append(f"{name}_sum{label_str(labels)} {round(self.total, 6)}")
+        out.append(f"{name}_count{label_str(labels)} {self.count}")
+        return out
+
+
+class BackendMetrics:
+    """ counters kept by one backend worker """
+    def __init__(self):
+        self.worker = None
+        self.results = {result: 0 for result in RESULTS}
+        self.recent = collections.deque()
+        self.latency = {}
+        self.last_write = 0
+
+    def job_done(self, result, plugin, action, secs=None):
+        """ record one job that finished with {result}, {secs} is how long the plug-in took """
+        self.results[result] += 1
+        self.recent.append((time.monotonic(), result))
+        if secs is not None:
+            if (key := (plugin, action)) not in self.latency:
+                self.latency[key] = Histogram()
+            self.latency[key].observe(secs)
+
+    def per_minute(self):
+        """ jobs of each result in the last minute """
+        since = time.monotonic() - 60
+        while len(self.recent) > 0 and self.recent[0][0] < since:
+            self.recent.popleft()
+        counts = {result: 0 for result in RESULTS}
+        for __, result in self.recent:
+            counts[result] += 1
+        return counts
+
+    def worker_lines(self, merge_counts):
+        labels = {"worker": self.worker}
+        out = family("pyrar_backend_jobs_total", "counter", "Backend jobs finished, by result",
+                     [({**labels, "result": result}, count) for result, count in self.results.items()])
+
+        out += family("pyrar_backend_jobs_last_minute", "gauge", "Backend jobs finished in the last minute, by result",
+                      [({**labels, "result": result}, count) for result, count in self.per_minute().items()])
+
+        out += family("pyrar_backend_merged_total", "counter", "Duplicate backend jobs merged",
+                      [({**labels, "how": tag}, count) for tag, count in merge_counts.items()])
+
+        out += ["# HELP pyrar_backend_run_seconds Time the plug-in took to run a job",
+                "# TYPE pyrar_backend_run_seconds histogram"]
+        for (plugin, action), histogram in sorted(self.latency.items()):
+            out += histogram.lines("pyrar_backend_run_seconds", {**labels, "plugin": plugin, "action": action})
+        return out
+
+    def write(self, worker, merge_counts, force=False):
+        """ write our metrics file, and the queue's if we get the lock, at most every `backend_metrics_interval` """
+        if not force and time.monotonic() < self.last_write + policy.policy("backend_metrics_interval"):
+            return
+        self.last_write = time.monotonic()
+        self.worker = worker
+        if not os.path.isdir(METRICS_DIR):
+            return
+
+        write_file(f"backend_{worker.replace(':', '_')}.prom", self.worker_lines(merge_counts))
+
+        ok, reply = sql.run_select(f"select get_lock(unhex('{QUEUE_LOCK}'),0) 'got'")
+        if not ok or len(reply) != 1 or reply[0]["got"] != 1:
+            return
+        try:
+            write_file(QUEUE_FILE, self.queue_lines())
+            remove_stale()
+        finally:
+            sql.run_select(f"select release_lock(unhex('{QUEUE_LOCK}')) 'done'")
+
+    def queue_lines(self):
+        """ depth & age of the queue by registry & job type, plus alert conditions """
+        max_tries = int(policy.policy("backend_retry_attempts"))
+        samples = {"depth": [], "due": [], "dead": [], "age": []}
+        for reg_name in registry.tld_lib.registry:
+            if (by_name := registry.tld_lib.name_in_registry_sql(reg_name, "domains.name")) is None:
+                continue
+            ok, reply = sql.run_select(
+                f"select job_type,sum(failures < {max_tries}) 'depth'," +
+                f"sum(failures < {max_tries} and execute_dt <= now()) 'due'," +
+                f"sum(failures >= {max_tries}) 'dead'," +
+                "timestampdiff(second,min(" +
+                f"if(failures < {max_tries} and execute_dt <= now(),execute_dt,NULL)),now()) 'age'" +
+                f" from backend join domains using(domain_id) where {by_name} group by job_type")
+            if not ok:
+                continue
+            for row in reply:
+                labels = {"registry": reg_name, "job_type": row["job_type"]}
+                for item in samples:
+                    samples[item].append((labels, int(row[item] or 0)))
+
+        oldest_due = max([age for __, age in samples["age"]] + [0])
+        out = family("pyrar_backend_queue_depth", "gauge", "Backend jobs waiting", samples["depth"])
+        out += family("pyrar_backend_queue_due", "gauge", "Backend jobs due to run now", samples["due"])
+        out += family("pyrar_backend_queue_dead", "gauge", "Backend jobs that have used up their retries",
+                      samples["dead"])
+        out += family("pyrar_backend_oldest_due_seconds", "gauge", "Age of the oldest job due to run", samples["age"])
+        out += family("pyrar_backend_alert", "gauge", "Backend alert conditions, 1 when firing",
+                      [({"condition": condition}, int(firing))
+                       for condition, firing in self.check_alerts(oldest_due).items()])
+        return out
+
+    def check_alerts(self, oldest_due):
+        """ alert conditions, from the counts of all workers, logged when they change from the last queue file """
+        last_min = {result: 0 for result in RESULTS}
+        for file in live_worker_files():
+            for labels, count in read_samples(file, "pyrar_backend_jobs_last_minute"):
+                if labels.get("result") in last_min:
+                    last_min[labels["result"]] += int(count)
+        finished = last_min["completed"] + last_min["retried"] + last_min["aborted"]
+        alerts = {
+            "oldest_due_age": oldest_due > policy.policy("backend_alert_oldest_due"),
+            "abort_rate": finished > 0 and last_min["aborted"] / finished > policy.policy("backend_alert_abort_rate")
+        }
+
+        was_firing = {
+            labels.get("condition"): count > 0
+            for labels, count in read_samples(f"{METRICS_DIR}/{QUEUE_FILE}", "pyrar_backend_alert")
+        }
+        for condition, firing in alerts.items():
+            if firing != was_firing.get(condition, False):
+                log(f"BACK-END ALERT {condition} is now {'FIRING' if firing else 'clear'}" +
+                    (f", oldest due job {oldest_due}s" if condition == "oldest_due_age" else "") +
+                    (f", {last_min['aborted']} of {finished} aborted" if condition == "abort_rate" else ""))
+        return alerts
+
+
+def live_worker_files():
+    """ metrics files of the workers that have written one in the last minute or so """
+    too_old = time.time() - 60 - policy.policy("backend_metrics_interval")
+    files = []
+    for file in os.listdir(METRICS_DIR):
+        path = f"{METRICS_DIR}/{file}"
+        if file.startswith("backend_") and file.endswith(".prom") and file != QUEUE_FILE:
+            if os.path.getmtime(path) >= too_old:
+                files.append(path)
+    return files
+
+
+def write_file(file, lines):
+    """ write atomically, so a scrape never sees half a file """
+    tmp_file = f"{METRICS_DIR}/.{file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as fd:
+        fd.write("\n".join(lines) + "\n")
+    os.replace(tmp_file, f"{METRICS_DIR}/{file}")
+
+
+def remove_stale():
+    """ remove the files of workers that have stopped """
+    too_old = time.time() - STALE_SECS
+    for file in os.listdir(METRICS_DIR):
+        path = f"{METRICS_DIR}/{file}"
+        if file.startswith("backend_") and file.endswith(".prom") and os.path.getmtime(path) < too_old:
+            os.remove(path)
+
+
+metrics = BackendMetrics()
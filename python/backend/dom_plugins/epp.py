@@ -13,7 +13,7 @@ from librar.log import log, init as log_init
 from librar.policy import this_policy as policy
 from librar import domobj, static, misc, registry
 from mailer import spool_email
-from backend import whois_priv, dom_req_xml, xmlapi, shared, parsexml, parse_dom_resp
+from backend import whois_priv, dom_req_xml, xmlapi, shared, parsexml, parse_dom_resp, info_cache
 
 from backend import dom_handler
 
@@ -82,6 +82,7 @@ def domain_renew(bke_job, dom):
 
     xml_dom = parse_dom_resp.parse_domain_info_xml(xml, "ren")
     sql.sql_update_one("domains", {"expiry_dt": xml_dom["expiry_dt"]}, {"domain_id": dom.dom_db["domain_id"]})
+    cache_update(dom, expiry_dt=xml_dom["expiry_dt"])
 
     return True
 
@@ -96,6 +97,7 @@ def domain_request_transfer(bke_job, dom):
     """ EPP transfer requested """
     name = dom.dom_db["name"]
     job_id = bke_job["backend_id"]
+    cache_invalidate(dom)
 
     if not shared.check_have_data(job_id, bke_job, ["num_years", "authcode"]):
         return transfer_failed(dom.dom_db["domain_id"])
@@ -170,21 +172,47 @@ def domain_info_raw(bke_job, dom):
     return epp_get_domain_info(dom.registry, bke_job["job_id"], dom.dom_db["name"], True)
 
 
-def epp_get_domain_info(this_reg, job_id, domain_name, as_raw=False):
-    """ Get domain info from EPP svr & return cooked result """
+def epp_get_domain_info(this_reg, job_id, domain_name, as_raw=False, stamp=None):
+    """ Get domain info from EPP svr & return cooked result, cached against the domain's {stamp}, if given """
     if this_reg is None or "url" not in this_reg:
         log(f"EPP-{job_id} '{domain_name}' this_reg or url not given")
         return None
 
+    if stamp is not None:
+        if (epp_info := info_cache.domain_info.get(this_reg["name"], domain_name, stamp)) is not None:
+            return epp_info
+
     xml = run_epp_request(this_reg, dom_req_xml.domain_info(domain_name))
 
     if xml_check_code(job_id, "info", xml):
         if as_raw:
             return xml
-        return parse_dom_resp.parse_domain_info_xml(xml, "inf")
+        epp_info = parse_dom_resp.parse_domain_info_xml(xml, "inf")
+        info_cache.domain_info.put(this_reg["name"], domain_name, epp_info, stamp)
+        return epp_info
     return None
 
 
+def cache_update(dom, **changes):
+    """ write-through the changes a job made to the cached info, if we have it, & tell the other workers """
+    reg_name = dom.registry["name"]
+    name = dom.dom_db["name"]
+    epp_info = info_cache.domain_info.get(reg_name, name, dom.dom_db.get("amended_dt"))
+    if (new_stamp := info_cache.bump_stamp(dom.dom_db)) is None or epp_info is None:
+        info_cache.domain_info.invalidate(reg_name, name)
+        return
+    epp_info.update(changes)
+    info_cache.domain_info.put(reg_name, name, epp_info, new_stamp)
+
+
+def cache_invalidate(dom):
+    """ drop any cached info for {dom}, e.g. after a job on it failed, the registry may have changed so
+    stop the other workers trusting theirs too """
+    if dom.registry is not None and dom.dom_db is not None:
+        info_cache.domain_info.invalidate(dom.registry["name"], dom.dom_db["name"])
+        info_cache.bump_stamp(dom.dom_db)
+
+
 def set_authcode(bke_job, dom):
     """ Set AUthCode on domain """
     name = dom.dom_db["name"]
@@ -206,7 +234,7 @@ def domain_update_flags(bke_job, dom):
     """ Update domain client flags to match database """
     job_id = bke_job["backend_id"]
     name = dom.dom_db["name"]
-    if (epp_info := epp_get_domain_info(dom.registry, job_id, name)) is None:
+    if (epp_info := epp_get_domain_info(dom.registry, job_id, name, stamp=dom.dom_db["amended_dt"])) is None:
         return False
 
     client_locks = {}
@@ -221,21 +249,54 @@ def domain_update_flags(bke_job, dom):
 
     update_xml = dom_req_xml.domain_update_flags(name, add_flags, del_flags)
 
-    return xml_check_code(job_id, "update", run_epp_request(dom.registry, update_xml))
+    if not xml_check_code(job_id, "update", run_epp_request(dom.registry, update_xml)):
+        cache_invalidate(dom)
+        return False
+
+    cache_update(dom, status=[item for item in epp_info["status"] if item not in del_flags] + add_flags)
+    return True
+
+
+def host_check_avail(this_reg, host_list):
+    """ run `host:check` in batches of `max_checks`, return dict of host -> True if it is available to create """
+    avail = {}
+    max_checks = this_reg["max_checks"] if misc.has_data(this_reg, "max_checks") else policy.policy("max_checks")
+    for start in range(0, len(host_list), max_checks):
+        xml = run_epp_request(this_reg, dom_req_xml.host_check(host_list[start:start + max_checks]))
+        if not xml_check_code("host", "check", xml) or not isinstance(xml.get("resData"), dict):
+            return None
+        if not isinstance(chk_data := xml["resData"].get("host:chkData"), dict) or "host:cd" not in chk_data:
+            log(f"EPP-{this_reg['name']}: host:check reply has no host:cd, checking hosts one at a time")
+            return None
+        chk_data = chk_data["host:cd"]
+        for item in chk_data if isinstance(chk_data, list) else [chk_data]:
+            host = item.get("host:name") if isinstance(item, dict) else None
+            if not isinstance(host, dict) or "#text" not in host:
+                return None
+            avail[host["#text"].lower()] = host.get("@avail") in ["1", "true"]
+    return avail
 
 
 def run_host_create(this_reg, host_list):
-    """ create hosts at EPP registry """
+    """ create hosts at EPP registry, skipping those we know already exist """
     # CODE - may need code for GLUE addresses
+    if len(host_list := info_cache.known_hosts.missing(this_reg["name"], host_list)) <= 0:
+        return
+
+    if (avail := host_check_avail(this_reg, host_list)) is not None:
+        info_cache.known_hosts.add(this_reg["name"], [host for host in host_list if not avail.get(host, True)])
+        host_list = [host for host in host_list if avail.get(host, True)]
+
     for host in host_list:
-        run_epp_request(this_reg, dom_req_xml.host_add(host))
+        if xml_check_code("host", "create", run_epp_request(this_reg, dom_req_xml.host_add(host))):
+            info_cache.known_hosts.add(this_reg["name"], [host])
 
 
 def domain_update_from_db(bke_job, dom):
     """ Update DS & NS records at EPP registry to match database """
     job_id = bke_job["backend_id"]
     name = dom.dom_db["name"]
-    if (epp_info := epp_get_domain_info(dom.registry, job_id, name)) is None:
+    if (epp_info := epp_get_domain_info(dom.registry, job_id, name, stamp=dom.dom_db["amended_dt"])) is None:
         return False
 
     if dom.registry is None or "url" not in dom.registry:
@@ -263,7 +324,12 @@ def domain_update_from_db(bke_job, dom):
 
     update_xml = dom_req_xml.domain_update(name, add_ns, del_ns, add_ds, del_ds)
 
-    return xml_check_code(job_id, "update", run_epp_request(dom.registry, update_xml))
+    if not xml_check_code(job_id, "update", run_epp_request(dom.registry, update_xml)):
+        cache_invalidate(dom)
+        return False
+
+    cache_update(dom, ns=ns_list, ds=ds_list)
+    return True
 
 
 def xml_check_code(job_id, desc, xml):
@@ -358,7 +424,8 @@ dom_handler.add_plugin(
         "dom/expired": domain_expired,
         "dom/flags": domain_update_flags,
         "dom/price": epp_domain_prices,
-        "dom/rawinfo": domain_info_raw
+        "dom/rawinfo": domain_info_raw,
+        "invalidate": cache_invalidate
     })
 
 if __name__ == "__main__":
@@ -87,9 +87,11 @@ def start_up_check():
 
 def check_tlds_exist():
     """ check all TLDs of type=local exist in pdns """
-    for zone, zone_rec in registry.tld_lib.zone_data.items():
-        if "reg_data" in zone_rec and zone_rec["reg_data"]["type"] == "local":
-            pdns.create_zone(zone, True, ensure_zone=True, client_zone=False, auto_catalog=True)
+    zones = [
+        zone for zone, zone_rec in registry.tld_lib.zone_data.items()
+        if "reg_data" in zone_rec and zone_rec["reg_data"]["type"] == "local"
+    ]
+    pdns.create_zones(zones, True, ensure_zone=True, client_zone=False, auto_catalog=True)
 
     return True
 
@@ -32,6 +32,18 @@ def host_add(hostname, ip_addrs=None):
     return host_xml
 
 
+def host_check(host_list):
+    """ JSON/XML to check if hosts exist """
+    return {
+        "check": {
+            "host:check": {
+                "@xmlns:host": "urn:ietf:params:xml:ns:host-1.0",
+                "host:name": host_list
+            }
+        }
+    }
+
+
 def domain_info(name):
     """ JSON/XML to get info on a domain """
     return {
@@ -47,6 +59,16 @@ def domain_info(name):
     }
 
 
+def poll_request():
+    """ JSON/XML to fetch the oldest message in the poll queue """
+    return {"poll": {"@op": "req"}}
+
+
+def poll_ack(msg_id):
+    """ JSON/XML to remove message {msg_id} from the poll queue """
+    return {"poll": {"@op": "ack", "@msgID": str(msg_id)}}
+
+
 def domain_request_transfer(name, authcode, years):
     """ JSON/XML to request a transfer """
     return {
@@ -0,0 +1,94 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" short lived caches of registry data, so consecutive jobs can share them
+
+Each worker has its own cache, so domain info is kept with the domain's `amended_dt` when it was read & only
+trusted while that has not changed. A worker that changes a domain at the registry moves `amended_dt` on, so
+the other workers stop trusting what they have cached """
+
+import copy
+import time
+import datetime
+
+from librar.mysql import sql_server as sql
+from librar.policy import this_policy as policy
+
+
+class InfoCache:
+    """ domain info keyed by registry & domain name, each entry lives for `epp_info_cache_ttl` seconds
+    & is only returned for the {stamp} it was stored with """
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, reg_name, name, stamp):
+        key = (reg_name, name)
+        if key in self.entries:
+            expires, entry_stamp, info = self.entries[key]
+            if expires > time.monotonic() and entry_stamp == stamp:
+                self.hits += 1
+                return copy.deepcopy(info)
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, reg_name, name, info, stamp):
+        if (ttl := policy.policy("epp_info_cache_ttl")) is None or ttl <= 0 or info is None or stamp is None:
+            return
+        self.entries[(reg_name, name)] = (time.monotonic() + ttl, stamp, copy.deepcopy(info))
+        if len(self.entries) > policy.policy("epp_info_cache_size"):
+            self.expire()
+
+    def invalidate(self, reg_name, name):
+        self.entries.pop((reg_name, name), None)
+
+    def expire(self):
+        now = time.monotonic()
+        for key in [key for key, (expires, __, __) in self.entries.items() if expires <= now]:
+            del self.entries[key]
+        while len(self.entries) > policy.policy("epp_info_cache_size"):
+            del self.entries[next(iter(self.entries))]
+
+
+def bump_stamp(dom_db):
+    """ move {dom_db}'s `amended_dt` on by at least a second, so every other worker's cached info for it no
+    longer matches, return the new value, None if another process changed it since {dom_db} was read """
+    old_stamp = dom_db.get("amended_dt")
+    new_stamp = datetime.datetime.now().replace(microsecond=0)
+    if old_stamp is not None:
+        new_stamp = max(new_stamp, datetime.datetime.strptime(old_stamp, "%Y-%m-%d %H:%M:%S") +
+                        datetime.timedelta(seconds=1))
+    new_stamp = new_stamp.strftime("%Y-%m-%d %H:%M:%S")
+
+    where = "amended_dt is NULL" if old_stamp is None else f"amended_dt='{old_stamp}'"
+    row_count, __ = sql.sql_exec(f"update domains set amended_dt='{new_stamp}'" +
+                                 f" where domain_id={int(dom_db['domain_id'])} and {where}")
+    if not row_count:
+        return None
+    dom_db["amended_dt"] = new_stamp
+    return new_stamp
+
+
+class HostCache:
+    """ hosts known to exist at each registry, remembered for `epp_host_cache_ttl` seconds """
+    def __init__(self):
+        self.hosts = {}
+
+    def missing(self, reg_name, host_list):
+        """ return the hosts in {host_list} not known to exist at {reg_name} """
+        now = time.monotonic()
+        known = self.hosts.get(reg_name, {})
+        return [host for host in host_list if host not in known or known[host] <= now]
+
+    def add(self, reg_name, host_list):
+        expires = time.monotonic() + policy.policy("epp_host_cache_ttl")
+        if reg_name not in self.hosts:
+            self.hosts[reg_name] = {}
+        for host in host_list:
+            self.hosts[reg_name][host] = expires
+
+
+domain_info = InfoCache()
+known_hosts = HostCache()
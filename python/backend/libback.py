@@ -20,6 +20,12 @@ def run(action, dom, bke_job):
     return this_handler[action](bke_job, dom)
 
 
+def invalidate(dom):
+    """ tell the plug-in anything it has cached about {dom} is no longer trusted """
+    if dom.registry is not None and (func := dom_handler.run(dom.registry["type"], "invalidate")) is not None:
+        func(dom)
+
+
 def get_prices(domlist, num_years, qry_type):
     this_handler = dom_handler.backend_plugins[domlist.registry["type"]]
     if "dom/price" not in this_handler:
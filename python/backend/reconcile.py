@@ -0,0 +1,198 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" sweep all domains of a registry with `domain:info` & report where the registry differs from our database """
+
+import os
+import sys
+import json
+import time
+import threading
+import argparse
+import concurrent.futures
+
+from librar.mysql import sql_server as sql
+from librar import registry, static, misc
+from librar.log import log, init as log_init
+from librar.policy import this_policy as policy
+from backend import shared, backend_creator
+from backend.dom_plugins import epp
+
+RECONCILE_BASE = f"{os.environ['BASE']}/storage/perm/reconcile"
+CHECKPOINT_FILE = f"{RECONCILE_BASE}/checkpoint.json"
+
+SWEEP_STATUS = [static.STATUS_LIVE, static.STATUS_EXPIRED]
+DB_FIX_COLS = {"expiry_dt": "expiry_dt", "reg_create_dt": "created_dt"}
+
+
+class RateLimit:
+    """ space out calls from all workers to at most {per_sec} a second """
+    def __init__(self, per_sec):
+        self.gap = 1 / per_sec if per_sec else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.gap <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            sleep_for = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.gap
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+
+
+def load_checkpoints():
+    if not os.path.isfile(CHECKPOINT_FILE):
+        return {}
+    with open(CHECKPOINT_FILE, "r", encoding="utf-8") as fd:
+        return json.load(fd)
+
+
+def save_checkpoints(checkpoints):
+    tmp_file = CHECKPOINT_FILE + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as fd:
+        json.dump(checkpoints, fd)
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+
+def registry_where(reg_name, after_id):
+    """ SQL to select live domains in all the TLDs run by {reg_name}, after {after_id} """
+    if (by_tld := registry.tld_lib.name_in_registry_sql(reg_name)) is None:
+        return None
+    status = ",".join([str(status_id) for status_id in SWEEP_STATUS])
+    return f"domain_id > {int(after_id)} and status_id in ({status}) and {by_tld}"
+
+
+def ds_diff(db_ds, epp_ds):
+    return ([ds for ds in db_ds if not epp.ds_in_list(ds, epp_ds)]
+            + [ds for ds in epp_ds if not epp.ds_in_list(ds, db_ds)])
+
+
+def compare_domain(dom_db, epp_info):
+    """ list the properties of {dom_db} that do not match the registry's {epp_info} """
+    diffs = {}
+    for col, epp_col in DB_FIX_COLS.items():
+        if epp_info[epp_col] != dom_db[col]:
+            diffs[col] = {"db": dom_db[col], "registry": epp_info[epp_col]}
+
+    ns_list, ds_list = shared.get_domain_lists(dom_db)
+    if sorted(ns_list) != sorted([ns.lower() for ns in epp_info["ns"]]):
+        diffs["ns"] = {"db": ns_list, "registry": epp_info["ns"]}
+    if len(ds_diff(ds_list, epp_info["ds"])) > 0:
+        diffs["ds"] = {"db": ds_list, "registry": epp_info["ds"]}
+
+    locks = []
+    if misc.has_data(dom_db, "client_locks"):
+        locks = ["client" + lock for lock in dom_db["client_locks"].split(",")]
+    epp_locks = [flag for flag in epp_info["status"] if flag[:6] == "client"]
+    if sorted(locks) != sorted(epp_locks):
+        diffs["client_locks"] = {"db": locks, "registry": epp_locks}
+
+    return diffs
+
+
+def apply_fixes(dom_db, diffs):
+    """ take the registry's dates, push our NS/DS/locks back to the registry """
+    db_cols = {col: diffs[col]["registry"] for col in DB_FIX_COLS if col in diffs and diffs[col]["registry"]}
+    if len(db_cols) > 0:
+        sql.sql_update_one("domains", db_cols, {"domain_id": dom_db["domain_id"]})
+    if "ns" in diffs or "ds" in diffs:
+        backend_creator.make_job("dom/update", dom_db)
+    if "client_locks" in diffs:
+        backend_creator.make_job("dom/flags", dom_db)
+
+
+class Sweeper:
+    """ run `domain:info` on all domains of one registry through a bounded pool of workers """
+    def __init__(self, this_reg, with_fix=False):
+        self.this_reg = this_reg
+        self.with_fix = with_fix
+        self.workers = this_reg["sessions"] if "sessions" in this_reg else 3
+        self.limiter = RateLimit(this_reg.get("max_rate", policy.policy("reconcile_rate")))
+        self.counts = {"checked": 0, "differ": 0, "failed": 0}
+        report_dir = misc.make_year_month_day_dir(RECONCILE_BASE)
+        self.report_file = os.path.join(report_dir, f"{this_reg['name']}.jsonl")
+
+    def info(self, dom_db):
+        self.limiter.wait()
+        return epp.epp_get_domain_info(self.this_reg, "SWEEP", dom_db["name"])
+
+    def run_chunk(self, executor, dom_dbs, report_fd):
+        for dom_db, epp_info in zip(dom_dbs, executor.map(self.info, dom_dbs)):
+            self.counts["checked"] += 1
+            if epp_info is None:
+                self.counts["failed"] += 1
+                report_fd.write(json.dumps({"name": dom_db["name"], "error": "info failed"}) + "\n")
+                continue
+
+            if len(diffs := compare_domain(dom_db, epp_info)) <= 0:
+                continue
+
+            self.counts["differ"] += 1
+            report_fd.write(json.dumps({"name": dom_db["name"], "domain_id": dom_db["domain_id"], "diffs": diffs}) +
+                            "\n")
+            if self.with_fix:
+                apply_fixes(dom_db, diffs)
+
+    def sweep(self, checkpoints, max_domains=None):
+        """ sweep from the last checkpoint, stopping after {max_domains} """
+        reg_name = self.this_reg["name"]
+        after_id = checkpoints.get(reg_name, 0)
+        chunk_size = policy.policy("reconcile_chunk")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor, open(
+                self.report_file, "a", encoding="utf-8") as report_fd:
+            while max_domains is None or self.counts["checked"] < max_domains:
+                if (where := registry_where(reg_name, after_id)) is None:
+                    break
+                ok, dom_dbs = sql.sql_select("domains", where, limit=chunk_size, order_by="domain_id")
+                if not ok:
+                    log(f"SWEEP-{reg_name}: ERROR: could not read domains after DOM-{after_id}, checkpoint kept")
+                    return self.counts
+                if len(dom_dbs) <= 0:
+                    after_id = 0
+                    break
+
+                self.run_chunk(executor, dom_dbs, report_fd)
+                report_fd.flush()
+                after_id = dom_dbs[-1]["domain_id"]
+                checkpoints[reg_name] = after_id
+                save_checkpoints(checkpoints)
+
+        checkpoints[reg_name] = after_id
+        save_checkpoints(checkpoints)
+        log(f"SWEEP-{reg_name}: checked {self.counts['checked']}, differ {self.counts['differ']}, " +
+            f"failed {self.counts['failed']}, " + ("complete" if after_id == 0 else f"paused at DOM-{after_id}"))
+        return self.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Registry Reconciliation Sweep')
+    parser.add_argument("-D", '--debug', action="store_true")
+    parser.add_argument("-r", '--registry', help="Only sweep this registry")
+    parser.add_argument("-m", '--max-domains', type=int, help="Stop each registry after this many domains")
+    parser.add_argument("-f", '--fix', action="store_true", help="Fix the database & queue backend jobs")
+    parser.add_argument("-R", '--restart', action="store_true", help="Ignore checkpoints & start from the beginning")
+    args = parser.parse_args()
+    log_init(with_debug=args.debug)
+
+    sql.connect("engine")
+    registry.start_up()
+
+    if not os.path.isdir(RECONCILE_BASE):
+        os.mkdir(RECONCILE_BASE)
+    checkpoints = {} if args.restart else load_checkpoints()
+
+    for reg_name, this_reg in registry.tld_lib.registry.items():
+        if this_reg["type"] != "epp" or "url" not in this_reg:
+            continue
+        if args.registry and args.registry != reg_name:
+            continue
+        print(reg_name, json.dumps(Sweeper(this_reg, args.fix).sweep(checkpoints, args.max_domains)))
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" pause / resume backend jobs for a registry, shared by all backend workers
+
+A registry is paused until the mtime of its `.pause` file, so all workers see the same state.
+Consecutive job failures, across all workers, are counted in its `.fails` file """
+
+import os
+import sys
+import time
+import fcntl
+import datetime
+
+from librar.mysql import sql_server as sql
+from librar import registry
+from librar.log import log
+
+PAUSE_DIR = f"{os.environ['BASE']}/storage/shared/paused"
+
+
+def pause_filename(reg_name):
+    return f"{PAUSE_DIR}/{reg_name}.pause"
+
+
+def fails_filename(reg_name):
+    return f"{PAUSE_DIR}/{reg_name}.fails"
+
+
+def count_failure(reg_name):
+    """ add one to the consecutive failures of {reg_name}, return the new count """
+    if not os.path.isdir(PAUSE_DIR):
+        os.makedirs(PAUSE_DIR, exist_ok=True)
+    fails_fd = os.open(fails_filename(reg_name), os.O_CREAT | os.O_RDWR, 0o660)
+    try:
+        fcntl.flock(fails_fd, fcntl.LOCK_EX)
+        data = os.pread(fails_fd, 32, 0)
+        failures = (int(data) if data.strip().isdigit() else 0) + 1
+        os.ftruncate(fails_fd, 0)
+        os.pwrite(fails_fd, str(failures).encode("utf-8"), 0)
+        return failures
+    finally:
+        os.close(fails_fd)
+
+
+def clear_failures(reg_name):
+    try:
+        os.remove(fails_filename(reg_name))
+    except FileNotFoundError:
+        pass
+
+
+def paused_until(reg_name):
+    """ return unix time {reg_name} is paused until, or None if not paused """
+    try:
+        until = os.path.getmtime(pause_filename(reg_name))
+    except FileNotFoundError:
+        return None
+    return until if until > time.time() else None
+
+
+def as_sql_dt(when):
+    return datetime.datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def pause(reg_name, seconds):
+    """ pause {reg_name} for {seconds} & move its waiting jobs to after the pause, in one update """
+    until = int(time.time() + seconds)
+    if not os.path.isdir(PAUSE_DIR):
+        os.makedirs(PAUSE_DIR, exist_ok=True)
+    file = pause_filename(reg_name)
+    with open(file, "w", encoding="utf-8"):
+        pass
+    os.utime(file, (until, until))
+    clear_failures(reg_name)
+
+    if (by_name := registry.tld_lib.name_in_registry_sql(reg_name, "domains.name")) is not None:
+        until_dt = as_sql_dt(until)
+        sql.sql_exec(f"update backend join domains using(domain_id) set backend.execute_dt = '{until_dt}'" +
+                     f" where {by_name} and backend.execute_dt < '{until_dt}' and backend.claimed_by is NULL")
+
+    log(f"Registry '{reg_name}' backend jobs paused until {as_sql_dt(until)}")
+    return until
+
+
+def resume(reg_name):
+    """ resume {reg_name} & make its waiting jobs due now """
+    try:
+        os.remove(pause_filename(reg_name))
+    except FileNotFoundError:
+        pass
+
+    if (by_name := registry.tld_lib.name_in_registry_sql(reg_name, "domains.name")) is not None:
+        sql.sql_exec("update backend join domains using(domain_id) set backend.execute_dt = now()" +
+                     f" where {by_name} and backend.execute_dt > now() and backend.claimed_by is NULL")
+
+    log(f"Registry '{reg_name}' backend jobs resumed")
+    return True
+
+
+if __name__ == "__main__":
+    sql.connect("engine")
+    registry.start_up()
+    if len(sys.argv) > 2:
+        pause(sys.argv[1], int(sys.argv[2]))
+    elif len(sys.argv) > 1:
+        resume(sys.argv[1])
+    print({reg: paused_until(reg) for reg in registry.tld_lib.registry})
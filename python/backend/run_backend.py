@@ -3,9 +3,14 @@
 # Alternative license arrangements possible, contact me for more information
 """ run job requests queued in table `backend` """
 
+import os
 import sys
 import json
+import time
+import random
+import socket
 import argparse
+import multiprocessing
 
 from librar.mysql import sql_server as sql
 from librar import registry
@@ -19,10 +24,111 @@ from actions import make_actions
 
 from backend import shared
 from backend import libback
+from backend import backend_creator
+from backend import reg_pause
+from backend.bke_metrics import metrics
 
 # dom/update included here in case dom.auto_renew changes
 RECREATE_ACTIONS_FOR = ["dom/update", "dom/renew", "dom/create", "dom/transfer", "dom/recover"]
 
+WORKER_ID = None
+
+merge_counts = {"requests_merged": 0, "collapsed_at_claim": 0}
+
+
+def worker_id():
+    """ name that identifies this worker's claims on `backend` rows, unique across hosts """
+    global WORKER_ID
+    if WORKER_ID is None or WORKER_ID[1] != os.getpid():
+        WORKER_ID = (f"{socket.gethostname()}:{os.getpid()}", os.getpid())
+    return WORKER_ID[0]
+
+
+def claim_jobs():
+    """ atomically lease a batch of due jobs to this worker, return them """
+    lease = int(policy.policy("backend_claim_lease"))
+    me = misc.ashex(worker_id())
+    query = (f"update backend set claimed_by=unhex('{me}'),claim_expiry_dt=date_add(now(),interval {lease} second)" +
+             f" where execute_dt <= now() and failures < {policy.policy('backend_retry_attempts')}" +
+             " and (claimed_by is NULL or claim_expiry_dt < now())" +
+             f" order by backend_id limit {int(policy.policy('backend_claim_batch'))}")
+    row_count, __ = sql.sql_exec(query)
+    if not row_count:
+        return []
+    ok, bke_jobs = sql.sql_select("backend", f"claimed_by=unhex('{me}') and claim_expiry_dt > now()",
+                                  order_by="backend_id")
+    return collapse_duplicates(bke_jobs) if ok else []
+
+
+def collapse_duplicates(bke_jobs):
+    """ registry sync jobs read the database when they run, so one job per domain covers all those queued so far """
+    keep_jobs = {}
+    for bke_job in bke_jobs:
+        if bke_job["job_type"] not in backend_creator.COALESCE_JOBS:
+            keep_jobs[bke_job["backend_id"]] = bke_job
+            continue
+
+        if (key := (bke_job["domain_id"], bke_job["job_type"])) in keep_jobs:
+            sql.sql_delete_one("backend", {"backend_id": bke_job["backend_id"], "claimed_by": worker_id()})
+            keep_jobs[key]["merged"] += bke_job["merged"] + 1
+            merge_counts["collapsed_at_claim"] += 1
+            continue
+
+        keep_jobs[key] = bke_job
+        query = (f"delete from backend where domain_id={int(bke_job['domain_id'])}" +
+                 f" and job_type=unhex('{misc.ashex(bke_job['job_type'])}')" +
+                 f" and backend_id<>{int(bke_job['backend_id'])}" +
+                 " and (claimed_by is NULL or claim_expiry_dt < now())")
+        if (row_count := sql.sql_exec(query)[0]):
+            bke_job["merged"] += row_count
+            merge_counts["collapsed_at_claim"] += row_count
+
+    return sorted(keep_jobs.values(), key=lambda bke_job: bke_job["backend_id"])
+
+
+def renew_claim(bke_job):
+    """ extend the lease on {bke_job}, False if we no longer hold it """
+    lease = int(policy.policy("backend_claim_lease"))
+    query = (f"update backend set claim_expiry_dt=date_add(now(),interval {lease} second)" +
+             f" where backend_id={int(bke_job['backend_id'])} and claimed_by=unhex('{misc.ashex(worker_id())}')")
+    row_count, __ = sql.sql_exec(query)
+    return row_count == 1
+
+
+def release_claim(bke_job):
+    """ give {bke_job} back to the queue without running it, a NULL `claimed_by` makes `claim_expiry_dt` moot """
+    sql.sql_update("backend", {"claimed_by": None}, {"backend_id": bke_job["backend_id"], "claimed_by": worker_id()})
+
+
+def take_slot(kind, name, limit):
+    """ take one of {limit} named DB locks, so the limit holds across all workers on all hosts """
+    for slot in range(limit):
+        lock_name = misc.ashex(f"pyrar.bke.{kind}.{name}.{slot}"[:64])
+        ok, reply = sql.run_select(f"select get_lock(unhex('{lock_name}'),0) 'got'")
+        if ok and len(reply) == 1 and reply[0]["got"] == 1:
+            return lock_name
+    return None
+
+
+def free_slot(lock_name):
+    if lock_name is not None:
+        sql.run_select(f"select release_lock(unhex('{lock_name}')) 'done'")
+
+
+def job_slots(bke_job, dom):
+    """ take a slot for the job's registry & type, return None if either is at its concurrency limit """
+    reg_limit = dom.registry["sessions"] if "sessions" in dom.registry else 3
+    if (reg_slot := take_slot("reg", dom.registry["name"], reg_limit)) is None:
+        return None
+
+    type_limits = policy.policy("backend_job_type_limits")
+    if type_limits is None or bke_job["job_type"] not in type_limits:
+        return [reg_slot]
+    if (type_slot := take_slot("type", bke_job["job_type"], type_limits[bke_job["job_type"]])) is None:
+        free_slot(reg_slot)
+        return None
+    return [reg_slot, type_slot]
+
 
 def job_worked(bke_job):
     """ job worked """
@@ -31,17 +137,48 @@ def job_worked(bke_job):
 
 def job_abort(bke_job):
     """ job should not be retried """
-    sql.sql_update_one("backend", {"failures": 9999}, {"backend_id": bke_job["backend_id"]})
+    sql.sql_update_one("backend", {
+        "failures": 9999,
+        "claimed_by": None
+    }, {"backend_id": bke_job["backend_id"]})
+
 
+def retry_delay(failures):
+    """ exponential back-off, capped at `backend_retry_max`, with full jitter on the upper half """
+    delay = min(policy.policy("backend_retry_timeout") * (2**failures), policy.policy("backend_retry_max"))
+    return int(delay / 2 + random.uniform(0, delay / 2))
 
-def job_failed(bke_job):
+
+def job_failed(bke_job, dom):
     """ job failed, but should be retried """
+    if (until := registry_failed(dom.registry["name"])) is not None:
+        return job_postpone(bke_job, until)
+
     sql.sql_update_one("backend", {
         "failures": bke_job["failures"] + 1,
-        "execute_dt": misc.now(policy.policy("backend_retry_timeout"))
+        "execute_dt": misc.now(retry_delay(bke_job["failures"])),
+        "claimed_by": None
     }, {"backend_id": bke_job["backend_id"]})
 
 
+def job_postpone(bke_job, until):
+    """ put the job back until its registry is unpaused, without counting it as a failure """
+    sql.sql_update_one("backend", {
+        "execute_dt": misc.now(max(int(until - time.time()), 0) + random.randint(0, 30)),
+        "claimed_by": None
+    }, {"backend_id": bke_job["backend_id"]})
+
+
+def registry_failed(reg_name):
+    """ count consecutive failures on {reg_name}, return when it is paused until, or None if it is not paused """
+    if (until := reg_pause.paused_until(reg_name)) is not None:
+        return until
+    if (failures := reg_pause.count_failure(reg_name)) < policy.policy("backend_breaker_failures"):
+        return None
+    log(f"Registry '{reg_name}' failed {failures} jobs in a row, pausing")
+    return reg_pause.pause(reg_name, policy.policy("backend_breaker_pause"))
+
+
 def post_processing(bke_job):
     """ job worked, but there's more to do """
     ok, dom_db = sql.sql_select_one("domains", {"domain_id": bke_job["domain_id"]})
@@ -63,10 +200,10 @@ def post_processing(bke_job):
 
 
 def run_backend_item(bke_job):
-    """ run a backend job """
+    """ run a backend job, return False if it had to be put back in the queue """
     job_id = bke_job["backend_id"]
     dom = domobj.Domain()
-    if not dom.set_by_id(bke_job["domain_id"]):
+    if not dom.set_by_id(bke_job["domain_id"])[0]:
         return job_abort(bke_job)
 
     if (misc.has_data(bke_job, "user_id") and bke_job["job_type"] != "dom/transfer"
@@ -74,38 +211,106 @@ def run_backend_item(bke_job):
         log(f"BKE-{job_id}: Domain '{dom.dom_db['name']}' is not owned by '{bke_job['user_id']}'")
         return job_abort(bke_job)
 
+    if (until := reg_pause.paused_until(dom.registry["name"])) is not None:
+        job_postpone(bke_job, until)
+        metrics.job_done("postponed", dom.registry["type"], bke_job["job_type"])
+        return False
+
+    if (slots := job_slots(bke_job, dom)) is None:
+        release_claim(bke_job)
+        return False
+
+    try:
+        run_locked_item(bke_job, dom)
+    finally:
+        for lock_name in slots:
+            free_slot(lock_name)
+    return True
+
+
+def run_locked_item(bke_job, dom):
+    """ run a backend job once we hold its concurrency slots """
+    job_id = bke_job["backend_id"]
+    start_time = time.monotonic()
     job_run = libback.run(bke_job["job_type"], dom, bke_job)
+    run_secs = time.monotonic() - start_time
 
     notes = (f"{libback.JOB_RESULT[job_run]}: BKE-{job_id} type '{dom.registry['type']}:{bke_job['job_type']}' " +
              f"on DOM-{bke_job['domain_id']} retries {bke_job['failures']}/" +
              f"{policy.policy('backend_retry_attempts')}")
 
+    if bke_job["merged"]:
+        merge_counts["requests_merged"] += bke_job["merged"]
+        notes += f", merged {bke_job['merged']} requests"
+
     log(notes)
     shared.event_log(notes, bke_job)
 
+    result = "aborted" if job_run is None else ("completed" if job_run else "retried")
+    metrics.job_done(result, dom.registry["type"], bke_job["job_type"], run_secs)
+
     if job_run is None:
+        libback.invalidate(dom)
         return job_abort(bke_job)
     if job_run:
-        post_processing(bke_job)
+        reg_pause.clear_failures(dom.registry["name"])
+        if not post_processing(bke_job):
+            libback.invalidate(dom)
         return job_worked(bke_job)
 
-    return job_failed(bke_job)
+    libback.invalidate(dom)
+    return job_failed(bke_job, dom)
+
+
+def run_claimed(bke_jobs):
+    """ run the jobs claimed, return True if any of them ran """
+    any_ran = False
+    for bke_job in bke_jobs:
+        if not renew_claim(bke_job):
+            log(f"BKE-{bke_job['backend_id']}: Lease lost, another worker has taken the job")
+            continue
+        if run_backend_item(bke_job) is not False:
+            any_ran = True
+    return any_ran
 
 
 def run_server():
     """ continuously run the backend processing """
-    log("BACK-END SERVER RUNNING")
+    log(f"BACK-END SERVER RUNNING as {worker_id()}")
     signal_mtime = None
+    logged_counts = merge_counts.copy()
     while True:
-        query = ("select * from backend where execute_dt <= now()" +
-                 f" and failures < {policy.policy('backend_retry_attempts')} order by backend_id limit 1")
-        ret, bke_job = sql.run_select(query)
-        if ret and len(bke_job) > 0:
-            run_backend_item(bke_job[0])
-        else:
-            signal_mtime = sigprocs.signal_wait("backend", signal_mtime)
-            if registry.tld_lib.check_for_new_files():
-                libback.start_ups()
+        metrics.write(worker_id(), merge_counts)
+        if len(bke_jobs := claim_jobs()) > 0 and run_claimed(bke_jobs):
+            continue
+        if logged_counts != merge_counts:
+            log(f"BACK-END MERGED: {json.dumps(merge_counts)}")
+            logged_counts = merge_counts.copy()
+        signal_mtime = sigprocs.signal_wait("backend", signal_mtime)
+        if registry.tld_lib.check_for_new_files():
+            libback.start_ups()
+
+
+def run_worker(is_live):
+    """ each worker process has its own database connection """
+    start_up(is_live)
+    run_server()
+
+
+def run_workers(is_live, num_workers):
+    """ run {num_workers} worker processes, restarting any that die """
+    if num_workers <= 1:
+        return run_worker(is_live)
+
+    log(f"BACK-END STARTING {num_workers} WORKERS")
+    workers = []
+    while True:
+        workers = [proc for proc in workers if proc.is_alive()]
+        while len(workers) < num_workers:
+            proc = multiprocessing.Process(target=run_worker, args=(is_live, ), daemon=True)
+            proc.start()
+            workers.append(proc)
+        time.sleep(5)
 
 
 def start_up(is_live):
@@ -129,15 +334,26 @@ def main():
     parser.add_argument("-s", '--start-up', action="store_true")
     parser.add_argument("-a", '--action', help="Plugin action")
     parser.add_argument("-d", '--domain', help="Plugin name")
+    parser.add_argument("-w", '--workers', type=int, help="Number of worker processes")
+    parser.add_argument("-p", '--pause', help="Pause jobs for this registry")
+    parser.add_argument("-m", '--minutes', type=int, default=60, help="Minutes to pause the registry for")
+    parser.add_argument("-r", '--resume', help="Resume jobs for this registry")
     args = parser.parse_args()
 
-    if args.debug:
+    if args.pause or args.resume:
         start_up(False)
-        return run_server()
+        if args.pause:
+            reg_pause.pause(args.pause, args.minutes * 60)
+        else:
+            reg_pause.resume(args.resume)
+        return 0
+
+    num_workers = args.workers if args.workers else policy.policy("backend_workers")
+    if args.debug:
+        return run_workers(False, num_workers)
 
     if args.live:
-        start_up(True)
-        return run_server()
+        return run_workers(True, num_workers)
 
     if args.start_up:
         start_up(args.live)
@@ -0,0 +1,240 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" drain the EPP poll queue of each registry & apply the messages to the database """
+
+import sys
+import json
+import time
+import argparse
+
+from librar.mysql import sql_server as sql
+from librar import registry, static, mysql
+from librar.log import log, init as log_init
+from librar.policy import this_policy as policy
+from backend import dom_req_xml, xmlapi, parse_dom_resp, backend_creator
+from backend.dom_plugins import epp
+
+TRANSFER_STATUS = [static.STATUS_TRANS_QUEUED, static.STATUS_TRANS_REQ]
+TRANSFER_DONE = {"clientApproved": True, "serverApproved": True}
+TRANSFER_FAILED = {"clientRejected": True, "clientCancelled": True, "serverCancelled": True}
+
+
+def update_domains(column_vals, where):
+    """ update `domains`, return False on an SQL error, which `sql_update` reports as success """
+    row_count, __ = sql.sql_exec("update domains set " + mysql.data_set(column_vals, ",", is_set=True) + " where " +
+                                 mysql.data_set(where, " and "))
+    return row_count is not None and row_count is not False
+
+
+class PollBatch:
+    """ changes collected from a registry's poll queue, applied before each message is acked """
+    def __init__(self, reg_name):
+        self.reg_name = reg_name
+        self.transfer_done = {}
+        self.transfer_failed = []
+        self.new_expiry = {}
+        self.resync = []
+        self.messages = 0
+        self.totals = {"transferred": 0, "failed": 0, "expiry": 0}
+
+    def add_expiry(self, store, name, expiry_dt):
+        if expiry_dt is None:
+            return
+        if expiry_dt not in store:
+            store[expiry_dt] = []
+        store[expiry_dt].append(name)
+
+    def add_transfer(self, trn_data):
+        name = trn_data["domain:name"].lower()
+        tr_status = trn_data["domain:trStatus"] if "domain:trStatus" in trn_data else None
+        if tr_status in TRANSFER_DONE:
+            self.add_expiry(self.transfer_done, name, parse_dom_resp.epp_dt_to_sql(trn_data, "domain:exDate"))
+        elif tr_status in TRANSFER_FAILED:
+            self.transfer_failed.append(name)
+        else:
+            log(f"POLL-{self.reg_name}: Transfer of '{name}' is '{tr_status}'")
+
+    def add_pending(self, pan_data):
+        pan_name = pan_data["domain:name"]
+        if not isinstance(pan_name, dict) or "#text" not in pan_name:
+            return
+        name = pan_name["#text"].lower()
+        if pan_name.get("@paResult", "0") in ["1", "true"]:
+            self.resync.append(name)
+        else:
+            log(f"POLL-{self.reg_name}: Pending action on '{name}' was rejected")
+
+    def add_message(self, xml):
+        """ sort one poll message into the type of change it needs """
+        self.messages += 1
+        if "resData" not in xml:
+            log(f"POLL-{self.reg_name}: {poll_text(xml)}")
+            return
+
+        res_data = xml["resData"]
+        if "domain:trnData" in res_data:
+            self.add_transfer(res_data["domain:trnData"])
+        elif "domain:panData" in res_data:
+            self.add_pending(res_data["domain:panData"])
+        elif "domain:infData" in res_data:
+            xml_dom = parse_dom_resp.parse_domain_info_xml(xml, "inf")
+            self.add_expiry(self.new_expiry, xml_dom["name"].lower(), xml_dom["expiry_dt"])
+        elif (low_bal := low_balance_data(res_data)) is not None:
+            log(f"POLL-{self.reg_name}: WARNING: Low balance, available credit " +
+                f"{low_bal.get('lowbalance-poll:availableCredit', 'Unknown')}",
+                default_level="warning")
+        else:
+            log(f"POLL-{self.reg_name}: Unhandled message {json.dumps(res_data)}")
+
+    def clear(self):
+        self.transfer_done = {}
+        self.transfer_failed = []
+        self.new_expiry = {}
+        self.resync = []
+
+    def moved_to_live(self, expiry_dt, names):
+        """ set the transfers-in in {names} live, return the names of the ones that were """
+        ok, reply = sql.sql_select("domains", {"name": names, "status_id": TRANSFER_STATUS}, columns="name")
+        if not ok:
+            return None
+        if len(live_names := [dom_db["name"] for dom_db in reply]) <= 0:
+            return []
+        ok = update_domains({
+            "status_id": static.STATUS_LIVE,
+            "expiry_dt": expiry_dt,
+            "amended_dt": None
+        }, {
+            "name": live_names,
+            "status_id": TRANSFER_STATUS
+        })
+        return live_names if ok else None
+
+    def apply(self):
+        """ apply the changes collected since the last apply using set based SQL, return False if any failed """
+        live_names = []
+        for expiry_dt, names in self.transfer_done.items():
+            if (names_done := self.moved_to_live(expiry_dt, names)) is None:
+                return False
+            live_names += names_done
+
+        if len(self.transfer_failed) > 0:
+            ok = update_domains({
+                "status_id": static.STATUS_TRANS_FAIL,
+                "amended_dt": None
+            }, {
+                "name": self.transfer_failed,
+                "status_id": TRANSFER_STATUS
+            })
+            if not ok:
+                return False
+
+        for expiry_dt, names in self.new_expiry.items():
+            if not update_domains({"expiry_dt": expiry_dt, "amended_dt": None}, {"name": names}):
+                return False
+
+        # only transfers-in & accepted pending actions need pushing back to the registry
+        update_names = live_names + self.resync
+        if len(update_names) > 0 and not backend_creator.make_jobs_for_names("dom/update", update_names):
+            log(f"POLL-{self.reg_name}: Failed to queue updates for {','.join(update_names)}")
+
+        self.totals["transferred"] += len(live_names)
+        self.totals["failed"] += len(self.transfer_failed)
+        self.totals["expiry"] += sum(len(names) for names in self.new_expiry.values())
+        self.clear()
+        return True
+
+    def log_event(self):
+        if self.messages > 0:
+            mysql.event_log({
+                "event_type": "Poll:" + self.reg_name,
+                "domain_id": None,
+                "user_id": None,
+                "who_did_it": "poller",
+                "from_where": "localhost",
+                "notes": (f"Poll {self.reg_name}: {self.messages} msgs, " +
+                          f"{self.totals['transferred']} transferred in, {self.totals['failed']} transfers failed, " +
+                          f"{self.totals['expiry']} new expiry")
+            })
+
+
+def poll_text(xml):
+    """ return the human readable text of a poll message """
+    if "msgQ" not in xml or "msg" not in xml["msgQ"]:
+        return "No message text"
+    msg = xml["msgQ"]["msg"]
+    return msg["#text"] if isinstance(msg, dict) and "#text" in msg else str(msg)
+
+
+def low_balance_data(res_data):
+    for tag, data in res_data.items():
+        if tag.find("lowbalance") >= 0 and isinstance(data, dict):
+            return data
+    return None
+
+
+def drain_registry(this_reg, max_msgs):
+    """ request & ack up to {max_msgs} poll messages from registry {this_reg} """
+    batch = PollBatch(this_reg["name"])
+    while batch.messages < max_msgs:
+        xml = epp.run_epp_request(this_reg, dom_req_xml.poll_request())
+        if (xml_code := xmlapi.xmlcode(xml)) != 1301:
+            if xml_code != 1300:
+                log(f"POLL-{this_reg['name']}: poll request gave {xml_code}")
+            break
+
+        if "msgQ" not in xml or "@id" not in xml["msgQ"]:
+            log(f"POLL-{this_reg['name']}: poll message has no id")
+            break
+
+        # EPP only gives out the next message once this one is acked, so it must be in the DB before we ack it
+        batch.add_message(xml)
+        if not batch.apply():
+            log(f"POLL-{this_reg['name']}: Failed to apply message {xml['msgQ']['@id']}, left on the queue")
+            break
+        ack = epp.run_epp_request(this_reg, dom_req_xml.poll_ack(xml["msgQ"]["@id"]))
+        if not epp.xml_check_code("poll", "ack", ack):
+            break
+
+    batch.log_event()
+    return batch.messages
+
+
+def drain_all():
+    """ drain every EPP registry, return True if any registry still has messages waiting """
+    max_msgs = policy.policy("epp_poll_batch")
+    more_waiting = False
+    for __, this_reg in registry.tld_lib.registry.items():
+        if this_reg["type"] == "epp" and "url" in this_reg:
+            if drain_registry(this_reg, max_msgs) >= max_msgs:
+                more_waiting = True
+    return more_waiting
+
+
+def run_server():
+    log("EPP POLLER RUNNING")
+    while True:
+        if not drain_all():
+            time.sleep(policy.policy("epp_poll_interval"))
+        registry.tld_lib.check_for_new_files()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EPP Poll Queue Runner')
+    parser.add_argument("-D", '--debug', action="store_true")
+    parser.add_argument("-1", '--once', action="store_true", help="Drain each registry once then exit")
+    args = parser.parse_args()
+    log_init(with_debug=args.debug)
+
+    sql.connect("engine")
+    registry.start_up()
+
+    if args.once:
+        drain_all()
+        sys.exit(0)
+
+    run_server()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,7 @@
 
 import argparse
 
-from librar import static
+from librar import static, registry, pdns, catalog_sync
 from librar.mysql import sql_server as sql
 from librar.log import init as log_init
 from librar.policy import this_policy as policy
@@ -48,11 +48,18 @@ def run_hourly_jobs():
     clear_old_session_keys()
 
 
+def sync_dns_catalogs():
+    registry.start_up()
+    pdns.start_up()
+    return catalog_sync.sync_all()
+
+
 def run_day_jobs():
     remove_password_reset()
     cancel_unpaid_orders()
     remove_old_one_time_payment_keys()
     remove_old_messages()
+    sync_dns_catalogs()
 
 
 if __name__ == "__main__":
@@ -12,9 +12,8 @@ import socket
 import ssl
 import time
 import atexit
+import threading
 import flask
-from apscheduler.schedulers.background import BackgroundScheduler
-from pytz import utc
 
 from librar.log import log, init as log_init
 from librar import static
@@ -57,15 +56,32 @@ log_init("logging_epp_api")
 jobInterval = this_login["keep_alive"] if "keep_alive" in this_login else 20
 
 
+eppLock = threading.Lock()
+lastUsed = time.monotonic()
+sessionStats = {"connectedAt": None, "requests": 0, "keepAlives": 0, "reconnects": 0}
+
+
 def keepAlive():
-    jsonRequest({"hello": None}, "keepAlive")
+    """ one timer thread, sleep until the session has been idle for `jobInterval` mins, then say hello """
+    idleLimit = jobInterval * 60
+    while True:
+        try:
+            idleFor = time.monotonic() - lastUsed
+            if idleFor < idleLimit:
+                time.sleep(idleLimit - idleFor)
+                continue
+            if conn is not None:
+                sessionStats["keepAlives"] += 1
+                jsonRequest({"hello": None}, "keepAlive")
+            else:
+                time.sleep(idleLimit)
+        except Exception as e:
+            log(f"keepAlive failed: {str(e)}")
+            time.sleep(idleLimit)
 
 
-scheduler = None
 if jobInterval > 0:
-    scheduler = BackgroundScheduler(timezone=utc)
-    scheduler.start(paused=True)
-    job = scheduler.add_job(keepAlive, 'interval', minutes=jobInterval, id='keepAlive')
+    threading.Thread(target=keepAlive, name="keepAlive", daemon=True).start()
 
 
 def closeEPP():
@@ -200,8 +216,14 @@ def firstDict(thisDict):
 
 
 def jsonRequest(in_js, addr):
+    global lastUsed
+    with eppLock:
+        lastUsed = time.monotonic()
+        return lockedJsonRequest(in_js, addr)
+
+
+def lockedJsonRequest(in_js, addr):
     global conn
-    global scheduler
 
     if conn is None:
         connectToEPP()
@@ -216,14 +238,12 @@ def jsonRequest(in_js, addr):
         if t2[0] == "@":
             t2 = in_js[t1][t2]
 
-    if jobInterval > 0 and scheduler is not None:
-        scheduler.reschedule_job('keepAlive', trigger='interval', minutes=jobInterval)
-        scheduler.resume()
-
+    sessionStats["requests"] += 1
     ret, js = xmlRequest(in_js)
 
     if ret is None or js is None:
         log("Reconnecting to EPP")
+        sessionStats["reconnects"] += 1
         conn.close()
         conn = None
         connectToEPP()
@@ -248,10 +268,22 @@ def eppJSON():
     return jsonRequest(flask.request.json, flask.request.remote_addr)
 
 
+@application.route('/api/epp/v1.0/stats', methods=['GET'])
+@application.route('/epp/api/v1.0/stats', methods=['GET'])
+def eppStats():
+    now = time.monotonic()
+    stats = sessionStats.copy()
+    stats["pid"] = os.getpid()
+    connectedAt = sessionStats["connectedAt"]
+    stats["sessionAge"] = int(now - connectedAt) if conn is not None and connectedAt is not None else None
+    stats["idleFor"] = int(now - lastUsed)
+    del stats["connectedAt"]
+    return flask.jsonify(stats)
+
+
 def connectToEPP():
 
     global conn
-    global scheduler
 
     context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
     context.load_cert_chain(client_pem)
@@ -274,9 +306,7 @@ def connectToEPP():
 
     ret, js = xmlRequest(makeLogin(this_login["username"], this_login["password"]))
     log(f"Login to '{this_reg}' gives {ret}")
-
-    if jobInterval > 0 and scheduler is not None:
-        scheduler.resume()
+    sessionStats["connectedAt"] = time.monotonic()
 
 
 if __name__ == "__main__":
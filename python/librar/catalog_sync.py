@@ -0,0 +1,117 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" bring the P/DNS catalog zones into line with the zones we should be serving
+
+The members each catalog should have are worked out from `domains` (or the local TLDs) & the zones
+in P/DNS, then only the differences are sent, in chunked PATCHes with one NOTIFY per catalog """
+
+import sys
+import json
+import argparse
+
+from librar.mysql import sql_server as sql
+from librar import pdns, static, registry
+from librar.log import log, init as log_init
+
+
+def catalog_members(catalog_zone):
+    """ {hash: member zone} of {catalog_zone}, None if it could not be loaded """
+    if (zone := pdns.load_zone(catalog_zone)) is None or "rrsets" not in zone:
+        return None
+    suffix = f".zones.{catalog_zone}."
+    members = {}
+    for rrset in zone["rrsets"]:
+        if rrset["type"] == "PTR" and rrset["name"].endswith(suffix) and len(rrset["records"]) > 0:
+            members[rrset["name"][:-len(suffix)]] = rrset["records"][0]["content"].lower()
+    return members
+
+
+def wanted_client_zones(pdns_zones):
+    """ domains, that are not expired, & have a zone in P/DNS """
+    ok, reply = sql.run_select(f"select name from domains where status_id <> {static.STATUS_EXPIRED}")
+    if not ok:
+        return None
+    return {dom_db["name"].lower() for dom_db in reply if dom_db["name"].lower() in pdns_zones}
+
+
+def wanted_tld_zones(pdns_zones):
+    """ local TLDs that have a zone in P/DNS """
+    return {
+        zone.lower()
+        for zone, zone_rec in registry.tld_lib.zone_data.items()
+        if "reg_data" in zone_rec and zone_rec["reg_data"]["type"] == "local" and zone.lower() in pdns_zones
+    }
+
+
+def catalog_changes(members, wanted):
+    """ rrsets to change {members} into {wanted} """
+    wanted_hashed = {pdns.hash_zone_name(name): name + "." for name in wanted}
+    changes = {"add": [], "remove": []}
+    for zone_hashed, name in wanted_hashed.items():
+        if members.get(zone_hashed) != name:
+            changes["add"].append((zone_hashed, name))
+    for zone_hashed in members:
+        if zone_hashed not in wanted_hashed:
+            changes["remove"].append((zone_hashed, None))
+    return changes
+
+
+def sync_catalog(client_zone=True, dry_run=False):
+    """ sync one catalog, return counts of what was (or would be) changed """
+    catalog_zone = pdns.get_catalog(client_zone)
+    if (pdns_zones := pdns.list_zones()) is None or (members := catalog_members(catalog_zone)) is None:
+        log(f"CATALOG: Failed to load P/DNS zones for '{catalog_zone}'")
+        return None
+
+    wanted = wanted_client_zones(pdns_zones) if client_zone else wanted_tld_zones(pdns_zones)
+    if wanted is None:
+        return None
+
+    changes = catalog_changes(members, wanted)
+    counts = {
+        "catalog": catalog_zone,
+        "members": len(members),
+        "wanted": len(wanted),
+        "add": len(changes["add"]),
+        "remove": len(changes["remove"])
+    }
+    if dry_run or counts["add"] + counts["remove"] <= 0:
+        return counts
+
+    batch = pdns.PdnsBatch()
+    for zone_hashed, name in changes["add"] + changes["remove"]:
+        batch.patch(f"{catalog_zone}.", pdns.catalog_ptr_rrset(catalog_zone, zone_hashed, name))
+    counts["ok"] = batch.flush()
+    log(f"CATALOG: Sync {json.dumps(counts)}")
+    return counts
+
+
+def sync_all(dry_run=False):
+    return [sync_catalog(client_zone, dry_run) for client_zone in [False, True]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync P/DNS catalog zones')
+    parser.add_argument("-D", '--debug', action="store_true")
+    parser.add_argument("-n", '--dry-run', action="store_true", help="Only report what would change")
+    parser.add_argument("-t", '--tlds', action="store_true", help="Only sync the TLDs catalog")
+    parser.add_argument("-c", '--clients', action="store_true", help="Only sync the clients catalog")
+    args = parser.parse_args()
+    log_init(with_debug=args.debug)
+
+    sql.connect("engine")
+    registry.start_up()
+    pdns.start_up()
+
+    if args.tlds or args.clients:
+        results = [sync_catalog(client_zone, args.dry_run) for client_zone in [False, True]
+                   if (args.clients if client_zone else args.tlds)]
+    else:
+        results = sync_all(args.dry_run)
+    print(json.dumps(results, indent=3))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
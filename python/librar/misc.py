@@ -100,6 +100,16 @@ def date_add(mysql_time, days=0, hours=0, years=0):
     return time_now.strftime("%Y-%m-%d %H:%M:%S")
 
 
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
 def make_year_month_day_dir(start_dir):
     for date_part in datetime.datetime.now().strftime("%Y,%m,%d").split(","):
         start_dir = os.path.join(start_dir, date_part)
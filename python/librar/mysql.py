@@ -148,6 +148,19 @@ def event_log(other_items, stack_pos=2):
     sql_server.sql_insert("events", event_db)
 
 
+def event_log_many(all_items, stack_pos=2):
+    """ log many events with one insert """
+    where = inspect.stack()[stack_pos]
+    event_dbs = [{
+        "program": where.filename.split("/")[-1].split(".")[0],
+        "function": where.function,
+        "line_num": where.lineno,
+        "when_dt": None,
+        **other_items
+    } for other_items in all_items]
+    return sql_server.sql_insert_many("events", event_dbs)
+
+
 def format_col(column, value, is_set=False):
     """ convert {value} to SQL string """
     if column is not None and value is None and (column in static.NOW_DATE_FIELDS or column[-3:] == "_dt"):
@@ -184,6 +197,17 @@ def data_set(data, joiner, is_set=False):
     return joiner.join([format_col(item, data[item], is_set) for item in data])
 
 
+def insert_many_sql(table, rows):
+    """ `insert` of all {rows}, every row must have the same columns """
+    columns = list(rows[0])
+    null_as = {col: "now()" if col in static.NOW_DATE_FIELDS or col[-3:] == "_dt" else "NULL" for col in columns}
+    values = []
+    for row in rows:
+        values.append("(" + ",".join(
+            [format_col(None, row[col]) if row[col] is not None else null_as[col] for col in columns]) + ")")
+    return f"insert into {table} ({','.join(columns)}) values " + ",".join(values)
+
+
 def first_not_mysql():
     for context in inspect.stack():
         if context.filename[-9:] != "/mysql.py":
@@ -286,6 +310,35 @@ class MariaDB:
         with_ignore = "ignore" if ignore else ""
         return self.sql_exec(f"insert {with_ignore} into {table} set " + data_set(column_vals, ",", is_set=True))
 
+    def sql_insert_many(self, table, rows):
+        """ insert all {rows} in one statement, every row must have the same columns """
+        if len(rows) <= 0:
+            return 0, None
+        return self.sql_exec(insert_many_sql(table, rows))
+
+    def sql_transaction(self, sqls):
+        """ run all {sqls} in one transaction, roll them all back if any fails, return True if committed """
+        if self.tcp_cnx is None:
+            log("Database is not connected for transaction")
+            return False
+
+        self.tcp_cnx.ping(True)
+        try:
+            self.tcp_cnx.query("start transaction")
+            for sql in sqls:
+                log_sql(sql)
+                self.tcp_cnx.query(sql)
+                self.tcp_cnx.store_result()
+            self.tcp_cnx.commit()
+            return True
+        except Exception as exc:
+            log("SQL-ERROR:" + str(exc))
+            try:
+                self.tcp_cnx.rollback()
+            except Exception:
+                pass
+            return False
+
     def sql_exists(self, table, where):
         sql = f"select 1 from {table} where " + data_set(where, " and ") + " limit 1"
         ret, __ = self.run_select(sql)
@@ -11,6 +11,8 @@ import secrets
 import hashlib
 import dns.name
 import requests
+import requests.adapters
+import concurrent.futures
 
 from librar.log import log, init as log_init
 from librar import misc
@@ -30,13 +32,15 @@ def start_up():
     if CLIENT is None:
         CLIENT = requests.Session()
         CLIENT.headers.update(headers)
+        # a pooled connection for each thread `PdnsBatch` runs calls on
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=policy.policy("pdns_workers"))
+        CLIENT.mount("http://", adapter)
 
     catalog_zone = policy.policy("catalog_zone")
-    for prefix in ["tlds.", "clients."]:
-        try:
-            create_zone(prefix + catalog_zone, False, ensure_zone=True, auto_catalog=False)
-        except requests.exceptions.ConnectionError:
-            raise requests.exceptions.ConnectionError("Failed to connect to PowerDNS")
+    try:
+        create_zones([prefix + catalog_zone for prefix in ["tlds.", "clients."]], ensure_zone=True, auto_catalog=False)
+    except requests.exceptions.ConnectionError:
+        raise requests.exceptions.ConnectionError("Failed to connect to PowerDNS")
 
 
 def find_best_ds(key_data):
@@ -83,31 +87,25 @@ def load_zone_keys(name):
     return json.loads(resp.content)
 
 
-def dnssec_zone_cmds(name):
-    """ rest/api calls to sign zone called {name}, name must have trailing "." """
+def dnssec_key_cmds(name):
+    """ rest/api calls to add signing keys to zone called {name}, name must have trailing "." """
     dnssec_algorithm = policy.policy("dnssec_algorithm")
-    dnssec_ksk_bits = policy.policy("dnssec_ksk_bits")
-    dnssec_zsk_bits = policy.policy("dnssec_zsk_bits")
-    nsec3param = misc.ashex(secrets.token_bytes(6))
     return [{
         "cmd": "POST",
         "url": f"{PDNS_BASE_URL}/zones/{name}/cryptokeys",
         "data": {
-            "keytype": "ksk",
-            "active": True,
-            "algorithm": f"{dnssec_algorithm}",
-            "bits": dnssec_ksk_bits
-        }
-    }, {
-        "cmd": "POST",
-        "url": f"{PDNS_BASE_URL}/zones/{name}/cryptokeys",
-        "data": {
-            "keytype": "zsk",
+            "keytype": keytype,
             "active": True,
             "algorithm": f"{dnssec_algorithm}",
-            "bits": dnssec_zsk_bits
+            "bits": policy.policy(f"dnssec_{keytype}_bits")
         }
-    }, {
+    } for keytype in ["ksk", "zsk"]]
+
+
+def dnssec_finish_cmds(name):
+    """ rest/api calls to run, in order, once zone {name} has its keys """
+    nsec3param = misc.ashex(secrets.token_bytes(6))
+    return [{
         "cmd": "PUT",
         "url": f"{PDNS_BASE_URL}/zones/{name}",
         "data": {
@@ -119,73 +117,157 @@ def dnssec_zone_cmds(name):
     }]
 
 
+def dnssec_zone_cmds(name):
+    """ rest/api calls to sign zone called {name}, name must have trailing "." """
+    return dnssec_key_cmds(name) + dnssec_finish_cmds(name)
+
+
+def is_ok(response):
+    return 200 <= response.status_code <= 299
+
+
+class PdnsBatch:
+    """ plan P/DNS calls for many zones. Calls in a stage are independent, so are run concurrently.
+    All the rrset changes for a zone are merged into one PATCH & each zone is NOTIFY'ed once, by `flush` """
+    def __init__(self):
+        self.rrsets = {}
+        self.notify = set()
+
+    def run_stage(self, cmds):
+        """ run {cmds} concurrently, return their responses in the same order """
+        if len(cmds) <= 1:
+            return [run_req(cmd) for cmd in cmds]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=policy.policy("pdns_workers")) as executor:
+            return list(executor.map(run_req, cmds))
+
+    def patch(self, zone, rrset):
+        """ queue {rrset} change for {zone}, a later change to the same name & type replaces an earlier one """
+        self.rrsets.setdefault(zone, {})[(rrset["name"], rrset["type"])] = rrset
+        self.notify.add(zone)
+
+    def notify_zone(self, zone):
+        self.notify.add(zone)
+
+    def flush(self):
+        """ send each zone's rrset changes in PATCHes of `pdns_patch_chunk` rrsets, then NOTIFY each changed zone.
+        Zones are PATCH'ed concurrently, but the chunks for one zone are sent one after the other """
+        chunk_size = policy.policy("pdns_patch_chunk")
+        chunks = {zone: list(rrsets.values()) for zone, rrsets in self.rrsets.items()}
+        ret = True
+        for start in range(0, max([len(rrsets) for rrsets in chunks.values()], default=0), chunk_size):
+            cmds = [{
+                "cmd": "PATCH",
+                "url": f"{PDNS_BASE_URL}/zones/{zone}",
+                "data": {
+                    "rrsets": rrsets[start:start + chunk_size]
+                }
+            } for zone, rrsets in chunks.items() if start < len(rrsets)]
+            ret = log_failed(cmds, self.run_stage(cmds)) and ret
+        self.run_stage([{"cmd": "PUT", "url": f"{PDNS_BASE_URL}/zones/{zone}/notify"} for zone in self.notify])
+        self.rrsets = {}
+        self.notify = set()
+        return ret
+
+
+def catalog_ptr_rrset(catalog_zone, zone_hashed, name=None):
+    """ rrset for member {zone_hashed} of {catalog_zone}, removing it if {name} is None """
+    return {
+        "name": f"{zone_hashed}.zones.{catalog_zone}.",
+        "ttl": 3600,
+        "type": "PTR",
+        "changetype": "REPLACE",
+        "records": [{
+            "content": f"{name}",
+            "disabled": False
+        }] if name is not None else []
+    }
+
+
+def catalog_rrset(name, client_zone, add):
+    catalog_zone = get_catalog(client_zone)
+    return f"{catalog_zone}.", catalog_ptr_rrset(catalog_zone, hash_zone_name(name), name if add else None)
+
+
 def create_zone(name, with_dnssec=False, ensure_zone=False, client_zone=True, auto_catalog=True):
     if name[-1] != ".":
         name += "."
+    return create_zones([name], with_dnssec, ensure_zone, client_zone, auto_catalog)[name]
+
+
+def create_zones(names, with_dnssec=False, ensure_zone=False, client_zone=True, auto_catalog=True):
+    """ create zones {names}, return {name: True or None}. Independent calls are run concurrently
+    & all the catalog changes are one PATCH & NOTIFY """
+    names = [name if name[-1] == "." else name + "." for name in names]
 
     dns_servers = policy.policy("dns_servers").split(",")
     for idx, ns in enumerate(dns_servers):
         if ns[-1] != ".":
             dns_servers[idx] += "."
 
-    response = run_one_cmd("POST", f"{PDNS_BASE_URL}/zones", {
-        "name": name,
-        "kind": "Master",
-        "masters": [],
-        "nameservers": dns_servers,
-        "soa_edit_api": "EPOCH"
-    })
-
-    if response.status_code >= 400:
-        if ensure_zone:
-            if auto_catalog:
-                add_to_catalog(name, client_zone)
-            return True
-        log(f"ERROR: Creating '{name}' failed, code={response.status_code} - {response.content}")
-        return None
-
-    post_json = []
-    if with_dnssec:
-        post_json += dnssec_zone_cmds(name)
-
     now = str(int(time.time()))
-
-    post_json += [{
-        "cmd": "PATCH",
-        "url": f"{PDNS_BASE_URL}/zones/{name}",
-        "data": {
+    zone_cmds = []
+    for name in names:
+        zone_data = {
+            "name": name,
+            "kind": "Master",
+            "masters": [],
+            "nameservers": dns_servers,
+            "soa_edit_api": "EPOCH",
             "rrsets": [{
-                "name":
-                f"{name}",
-                "ttl":
-                policy.policy("default_ttl"),
-                "type":
-                "SOA",
-                "changetype":
-                "REPLACE",
+                "name": name,
+                "ttl": policy.policy("default_ttl"),
+                "type": "SOA",
+                "changetype": "REPLACE",
                 "records": [{
                     "content": f"{dns_servers[0]} hostmaster.{name} {now} 10800 3600 604800 3600",
                     "disabled": False
                 }]
             }]
         }
-    }, {
-        "cmd": "POST",
-        "url": f"{PDNS_BASE_URL}/zones/{name}/metadata",
-        "data": {
-            "type": "Metadata",
-            "kind": "SOA-EDIT-DNSUPDATE",
-            "metadata": ["EPOCH"]
-        }
-    }, {
-        "cmd": "PUT",
-        "url": f"{PDNS_BASE_URL}/zones/{name}/notify"
-    }]
+        zone_cmds.append({"cmd": "POST", "url": f"{PDNS_BASE_URL}/zones", "data": zone_data})
+
+    batch = PdnsBatch()
+    results = {}
+    created = []
+    for name, response in zip(names, batch.run_stage(zone_cmds)):
+        if is_ok(response):
+            results[name] = True
+            created.append(name)
+        elif ensure_zone:
+            results[name] = True
+        else:
+            log(f"ERROR: Creating '{name}' failed, code={response.status_code} - {response.content}")
+            results[name] = None
+
+    setup_cmds = []
+    for name in created:
+        setup_cmds.append({
+            "cmd": "POST",
+            "url": f"{PDNS_BASE_URL}/zones/{name}/metadata",
+            "data": {
+                "type": "Metadata",
+                "kind": "SOA-EDIT-DNSUPDATE",
+                "metadata": ["EPOCH"]
+            }
+        })
+        if with_dnssec:
+            setup_cmds += dnssec_key_cmds(name)
+        batch.notify_zone(name)
+    log_failed(setup_cmds, batch.run_stage(setup_cmds))
+
+    if with_dnssec:
+        # NSEC3PARAM needs the keys & rectify needs the NSEC3PARAM, so one stage for each
+        finish_cmds = [dnssec_finish_cmds(name) for name in created]
+        for step in range(2):
+            stage_cmds = [cmds[step] for cmds in finish_cmds]
+            log_failed(stage_cmds, batch.run_stage(stage_cmds))
 
-    run_cmds(post_json)
     if auto_catalog:
-        add_to_catalog(name, client_zone)
-    return True
+        for name in names:
+            if results[name]:
+                batch.patch(*catalog_rrset(name, client_zone, True))
+    batch.flush()
+    return results
 
 
 def unsign_zone(name):
@@ -205,7 +287,9 @@ def unsign_zone(name):
     for key in keys:
         post_json.append({"cmd": "DELETE", "url": f"{PDNS_BASE_URL}/zones/{name}/cryptokeys/{key['id']}"})
 
-    return run_cmds(post_json)
+    ret = run_cmds(post_json)
+    zone_cache.forget(name)
+    return ret
 
 
 def run_one_cmd(cmd, url, json_data):
@@ -213,6 +297,19 @@ def run_one_cmd(cmd, url, json_data):
     return CLIENT.send(request.prepare())
 
 
+def run_req(req):
+    return run_one_cmd(req["cmd"], req["url"], req["data"] if "data" in req else None)
+
+
+def log_failed(post_json, responses):
+    ret = True
+    for req, response in zip(post_json, responses):
+        if not is_ok(response):
+            ret = False
+            log(f"PDNS-ERROR: {req['cmd']} {req['url']} - {response.content}")
+    return ret
+
+
 def run_cmds(post_json):
     ret = True
     for req in post_json:
@@ -228,6 +325,7 @@ def sign_zone(name):
     if name[-1] != ".":
         name += "."
     run_cmds(dnssec_zone_cmds(name))
+    zone_cache.forget(name)
     return load_zone_keys(name)
 
 
@@ -236,67 +334,51 @@ def get_catalog(client_zone):
     return "clients." + catalog if client_zone else "tlds." + catalog
 
 
-def delete_from_catalog(name, client_zone=True):
-    if name[-1] != ".":
-        name += "."
-    catalog_zone = get_catalog(client_zone)
-    zone_hashed = hash_zone_name(name)
+def catalog_update(add_names=None, del_names=None, client_zone=True):
+    """ add & remove many zones from a catalog, with chunked PATCHes & one NOTIFY """
+    batch = PdnsBatch()
+    for names, add in [(add_names, True), (del_names, False)]:
+        for name in names if names is not None else []:
+            batch.patch(*catalog_rrset(name if name[-1] == "." else name + ".", client_zone, add))
+    return batch.flush()
 
-    post_json = [{
-        "cmd": "PATCH",
-        "url": f"{PDNS_BASE_URL}/zones/{catalog_zone}.",
-        "data": {
-            "rrsets": [{
-                "name": f"{zone_hashed}.zones.{catalog_zone}.",
-                "ttl": 3600,
-                "type": "PTR",
-                "changetype": "REPLACE",
-                "records": []
-            }]
-        }
-    }, {
-        "cmd": "PUT",
-        "url": f"{PDNS_BASE_URL}/zones/{catalog_zone}./notify"
-    }]
 
-    return run_cmds(post_json)
+def delete_from_catalog(name, client_zone=True):
+    return catalog_update(del_names=[name], client_zone=client_zone)
 
 
 def add_to_catalog(name, client_zone=True):
-    if name[-1] != ".":
-        name += "."
-    catalog_zone = get_catalog(client_zone)
-    zone_hashed = hash_zone_name(name)
+    return catalog_update(add_names=[name], client_zone=client_zone)
 
-    post_json = [{
-        "cmd": "PATCH",
-        "url": f"{PDNS_BASE_URL}/zones/{catalog_zone}.",
-        "data": {
-            "rrsets": [{
-                "name": f"{zone_hashed}.zones.{catalog_zone}.",
-                "ttl": 3600,
-                "type": "PTR",
-                "changetype": "REPLACE",
-                "records": [{
-                    "content": f"{name}",
-                    "disabled": False
-                }]
-            }]
-        }
-    }, {
-        "cmd": "PUT",
-        "url": f"{PDNS_BASE_URL}/zones/{catalog_zone}./notify"
-    }]
 
-    return run_cmds(post_json)
+def list_zones():
+    """ names of all the zones in P/DNS, without the trailing "." """
+    resp = CLIENT.get(f"{PDNS_BASE_URL}/zones")
+    if resp.status_code < 200 or resp.status_code > 299:
+        return None
+    return {zone["name"].rstrip(".").lower() for zone in json.loads(resp.content)}
 
 
 def delete_zone(name):
     if name[-1] != ".":
         name += "."
+    return delete_zones([name])[name]
 
-    delete_from_catalog(name)
-    return run_cmds([{"cmd": "DELETE", "url": f"{PDNS_BASE_URL}/zones/{name}"}])
+
+def delete_zones(names):
+    """ delete zones {names}, with one catalog PATCH & NOTIFY for them all, return {name: deleted} """
+    names = [name if name[-1] == "." else name + "." for name in names]
+    batch = PdnsBatch()
+    for name in names:
+        batch.patch(*catalog_rrset(name, True, False))
+    batch.flush()
+
+    cmds = [{"cmd": "DELETE", "url": f"{PDNS_BASE_URL}/zones/{name}"} for name in names]
+    responses = batch.run_stage(cmds)
+    for name in names:
+        zone_cache.forget(name)
+    log_failed(cmds, responses)
+    return {name: is_ok(response) for name, response in zip(names, responses)}
 
 
 def update_rrs(zone, rrs):
@@ -318,6 +400,7 @@ def update_rrs(zone, rrs):
         rr_data["records"] = [{"content": val, "disabled": False} for val in rrs["data"]]
 
     resp = CLIENT.patch(f"{PDNS_BASE_URL}/zones/{zone}", json={"rrsets": [rr_data]}, headers=headers)
+    zone_cache.forget(zone)
 
     ok = resp.status_code >= 200 and resp.status_code <= 299
     if ok and len(resp.content) == 0:
@@ -346,6 +429,66 @@ def update_rrs(zone, rrs):
     return False, err_txt
 
 
+class ZoneCache:
+    """ zones, with their keys & DS if signed, as last loaded. A zone is only loaded again when the small
+    zone listing from P/DNS shows a different serial, edited serial or DNSSEC state, or after `pdns_cache_ttl`.
+    With `SOA-EDIT-API` EPOCH, two edits in the same second give the same serial, so a zone loaded in the
+    second of its edited serial is not trusted """
+    def __init__(self):
+        self.zones = {}
+
+    def zone_info(self, name):
+        """ the zone listing for {name}, without its records, None if it is not in P/DNS """
+        resp = CLIENT.get(f"{PDNS_BASE_URL}/zones", params={"zone": name})
+        if resp.status_code < 200 or resp.status_code > 299:
+            return None
+        for zone in json.loads(resp.content):
+            if zone["name"].lower() == name.lower():
+                return zone
+        return None
+
+    def load(self, name):
+        """ zone {name}, None if it is not in P/DNS - one small GET if it has not changed """
+        if name[-1] != ".":
+            name += "."
+        if (info := self.zone_info(name)) is None:
+            self.forget(name)
+            return None
+
+        version = [info.get(prop) for prop in ["serial", "edited_serial", "dnssec"]]
+        cached = self.zones.get(name)
+        if (cached is None or cached["version"] != version or cached["expires"] < time.monotonic()
+                or same_second(info.get("edited_serial"), cached["loaded_at"])):
+            loaded_at = time.time()
+            if (zone := load_zone(name)) is None:
+                return None
+            if "dnssec" in zone and zone["dnssec"]:
+                zone["keys"] = load_zone_keys(name)
+                zone["ds"] = find_best_ds(zone["keys"])
+            cached = {
+                "version": version,
+                "zone": zone,
+                "expires": time.monotonic() + policy.policy("pdns_cache_ttl"),
+                "loaded_at": loaded_at
+            }
+            self.forget(name)
+            self.zones[name] = cached
+            while len(self.zones) > policy.policy("pdns_cache_size"):
+                del self.zones[next(iter(self.zones))]
+
+        return dict(cached["zone"])
+
+    def forget(self, name):
+        self.zones.pop(name if name[-1] == "." else name + ".", None)
+
+
+def same_second(serial, loaded_at):
+    """ True if {serial} is an EPOCH serial that could be for an edit made after {loaded_at} """
+    return isinstance(serial, int) and abs(serial - loaded_at) <= 1
+
+
+zone_cache = ZoneCache()
+
 
 def main():
     log_init(with_debug=True)
@@ -10,6 +10,18 @@ from librar import fileloader
 
 policy_defaults = {
     "smtp_tls_security_level": "may",
+    "smtp_timeout": 60,
+    "smtp_max_messages": 100,
+    "smtp_idle_timeout": 30,
+    "spooler_workers": 4,
+    "spooler_domain_limit": 2,
+    "spooler_max_wait": 60,
+    "spool_bulk_chunk": 500,
+    "spool_backend": "files",
+    "spool_segment_size": 67108864,
+    "spool_segment_claim": 50,
+    "spool_claim_lease": 900,
+    "spool_compact_interval": 300,
     "locks": static.CLIENT_DOM_FLAGS,
     "default_theme": "dark",
     "strict_idna2008": False,
@@ -36,11 +48,38 @@ policy_defaults = {
     "dnssec_algorithm": "ecdsa256",
     "dnssec_ksk_bits": 256,
     "dnssec_zsk_bits": 256,
+    "pdns_workers": 8,
+    "pdns_patch_chunk": 1000,
+    "pdns_cache_ttl": 300,
+    "pdns_cache_size": 1000,
     "dns_servers": static.DEFAULT_NS,
     "catalog_zone": "pyrar.localhost",
     "default_ttl": 86400,
     "backend_retry_timeout": 300,
     "backend_retry_attempts": 3,
+    "backend_retry_max": 3600,
+    "backend_breaker_failures": 5,
+    "backend_breaker_pause": 600,
+    "backend_workers": 4,
+    "backend_claim_batch": 5,
+    "backend_claim_lease": 600,
+    "backend_job_type_limits": None,
+    "backend_metrics_interval": 60,
+    "actions_batch": 500,
+    "actions_claim_lease": 900,
+    "actions_rebuild_chunk": 500,
+    "actions_lookahead": 3600,
+    "actions_coalesce": 2,
+    "actions_max_sleep": 300,
+    "backend_alert_oldest_due": 900,
+    "backend_alert_abort_rate": 0.2,
+    "epp_poll_interval": 300,
+    "epp_poll_batch": 250,
+    "reconcile_rate": 5,
+    "reconcile_chunk": 100,
+    "epp_info_cache_ttl": 120,
+    "epp_info_cache_size": 10000,
+    "epp_host_cache_ttl": 86400,
     "renew_limit": 10,
     "max_checks": 5,
     "max_basket_size": 10,
@@ -49,6 +88,7 @@ policy_defaults = {
     "domain_transfer_age": 30,
     "auto_renew_before": 14,
     "renewal_reminders": "30,14,7",
+    "reminder_digest_window": 86400,
     "orders_erase_days": 30,
     "create_erase_days": 14,
     "new_order_remind_cancel": [1, 2, 6, 6.75],
@@ -62,11 +102,13 @@ class Policy:
     def __init__(self):
         self.file = fileloader.FileLoader(static.POLICY_FILE)
         self.all_data = None
+        self.generation = 0
         self.merge_policy_data()
 
     def merge_policy_data(self):
         self.all_data = policy_defaults.copy()
         self.all_data.update(self.file.data())
+        self.generation += 1
 
     def check_file(self):
         if self.file.check_for_new():
@@ -204,6 +204,15 @@ class ZoneLib:
     def url(self, registry):
         return self.registry[registry]["url"]
 
+    def tlds_for_registry(self, reg_name):
+        return [tld for tld, zone_rec in self.zone_data.items() if zone_rec["registry"] == reg_name]
+
+    def name_in_registry_sql(self, reg_name, column="name"):
+        """ SQL clause, true if domain name in {column} is in a TLD run by {reg_name} """
+        if len(tlds := self.tlds_for_registry(reg_name)) <= 0:
+            return None
+        return "(" + " or ".join([f"{column} like concat('%.',unhex('{misc.ashex(tld)}'))" for tld in tlds]) + ")"
+
     def reg_record_for_domain(self, domain):
         if (tld := self.tld_of_name(domain)) is None or tld not in self.zone_data:
             return None
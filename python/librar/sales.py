@@ -9,9 +9,10 @@ from librar import mysql
 from librar.mysql import sql_server as sql
 
 
-def sold_item(trans_id, order_db, dom_db, user_db):
+def sale_record(trans_id, order_db, dom_db, user_db):
+    """ `sales` row for {order_db} on {dom_db}, paid for by {user_db} in {trans_id} """
     this_reg = registry.tld_lib.reg_record_for_domain(dom_db["name"])
-    sales = {
+    return {
         "transaction_id": trans_id,
         "price_charged": order_db["price_charged"],
         "currency_charged": order_db["currency_charged"],
@@ -28,7 +29,9 @@ def sold_item(trans_id, order_db, dom_db, user_db):
         "been_refunded": False
     }
 
-    ok, row_id = sql.sql_insert("sales", sales)
+
+def sold_item(trans_id, order_db, dom_db, user_db):
+    ok, row_id = sql.sql_insert("sales", sale_record(trans_id, order_db, dom_db, user_db))
 
     mysql.event_log(
         {
@@ -1,28 +1,80 @@
 #! /usr/bin/python3
 # (c) Copyright 2019-2022, James Stevens ... see LICENSE for details
 # Alternative license arrangements possible, contact me for more information
-""" notice when a signal file gets touched """
+""" wake up services when they have work to do
+
+Each waiting process binds a unix datagram socket in the signals directory & `signal_service`
+sends a datagram to every socket for that service. The `.sig` file's mtime is still touched, and
+checked, as a fall-back for anything that can only touch the file """
 
 import os
 import sys
+import glob
 import time
+import errno
+import select
+import socket
 
 from librar import fileloader
+from librar.log import log
+
+SIG_FILE_MODE = 0o664
+SOCK_FILE_MODE = 0o660
+
+waiters = {}
+
+
+def signals_dir():
+    return f"{os.environ['BASE']}/storage/shared/signals"
 
 
 def signal_filename(sig_name):
-    return f"{os.environ['BASE']}/storage/shared/signals/{sig_name}.sig"
+    return f"{signals_dir()}/{sig_name}.sig"
+
+
+def socket_filename(sig_name, pid):
+    return f"{signals_dir()}/{sig_name}.{pid}.sock"
 
 
 def signal_service(sig_name):
+    """ best effort, failing to signal is logged, the waiting service will still poll for work """
     file = signal_filename(sig_name)
-    now = int(time.time())
-    if not os.path.isfile(file):
-        remake_sig_file(file)
-    file_mtime = os.path.getmtime(file)
-    if file_mtime == now:
-        now += 1
-    os.utime(file, (now, now))
+    try:
+        if not os.path.isfile(file):
+            remake_sig_file(file)
+        touch_sig_file(file)
+    except OSError as exc:
+        log(f"SIGNAL: Failed to touch '{file}' - {exc}")
+    wake_waiters(sig_name)
+
+
+def touch_sig_file(file):
+    """ move {file}'s mtime forward, setting an exact time needs us to own it, otherwise just use `now` """
+    now = time.time_ns()
+    file_mtime = os.stat(file).st_mtime_ns
+    if file_mtime >= now:
+        now = file_mtime + 1000
+    try:
+        os.utime(file, ns=(now, now))
+    except PermissionError:
+        os.utime(file)
+
+
+def wake_waiters(sig_name):
+    """ send a datagram to every process waiting on {sig_name}, removing sockets nobody is listening on """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for sock_file in glob.glob(socket_filename(sig_name, "*")):
+            try:
+                sock.sendto(b"!", sock_file)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.remove(sock_file)
+                except FileNotFoundError:
+                    pass
+            except OSError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                    log(f"SIGNAL: Failed to wake '{sock_file}' - {exc}")
 
 
 def remake_sig_file(file):
@@ -33,38 +85,91 @@ def remake_sig_file(file):
         pass
     with open(file, "w", encoding="utf-8"):
         pass
+    os.chmod(file, SIG_FILE_MODE)
     return fileloader.have_newer(None, file)
 
 
-def signal_wait(sig_name, prev_mtime=None, loop_time=1, max_wait=30):
-    file = signal_filename(sig_name)
-    if not os.path.isfile(file):
-        remake_sig_file(file)
+class SignalWaiter:
+    """ wait for `signal_service` to be called for {sig_name} """
+    def __init__(self, sig_name):
+        self.sig_name = sig_name
+        self.file = signal_filename(sig_name)
+        self.sock = None
+        self.sock_file = None
+        self.bind()
 
-    try:
-        loop_mtime = fileloader.have_newer(prev_mtime, file)
-    except PermissionError:
-        loop_mtime = remake_sig_file(file)
-
-    if loop_mtime is None:
-        loop_mtime = prev_mtime
-
-    total_waited = 0
-    while True:
+    def bind(self):
+        """ bind our socket, any signal sent after this will not be lost """
+        self.sock_file = socket_filename(self.sig_name, os.getpid())
+        try:
+            os.remove(self.sock_file)
+        except FileNotFoundError:
+            pass
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(self.sock_file)
+            os.chmod(self.sock_file, SOCK_FILE_MODE)
+            self.sock.setblocking(False)
+        except OSError:
+            self.sock = None
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.remove(self.sock_file)
+            except FileNotFoundError:
+                pass
+
+    def drain(self):
+        """ read all queued datagrams, return True if there were any """
+        got_one = False
+        while True:
+            try:
+                self.sock.recv(64)
+                got_one = True
+            except BlockingIOError:
+                return got_one
+
+    def mtime(self):
+        if not os.path.isfile(self.file):
+            return remake_sig_file(self.file)
         try:
-            next_mtime = fileloader.have_newer(loop_mtime, file)
+            return fileloader.have_newer(None, self.file)
         except PermissionError:
-            next_mtime = remake_sig_file(file)
+            return remake_sig_file(self.file)
 
-        if next_mtime is not None:
-            break
+    def wait(self, prev_mtime=None, timeout=30, loop_time=1):
+        """ wait up to {timeout} secs for a signal, return (signalled, mtime) """
+        if self.sock is None:
+            self.bind()
+
+        if self.sock is not None and self.drain():
+            return True, self.mtime()
+
+        start_mtime = self.mtime() if prev_mtime is None else prev_mtime
+        give_up = time.monotonic() + timeout
+        while (wait_for := give_up - time.monotonic()) > 0:
+            if self.sock is None:
+                time.sleep(min(loop_time, wait_for))
+            else:
+                readable, __, __ = select.select([self.sock], [], [], min(loop_time, wait_for))
+                if readable and self.drain():
+                    return True, self.mtime()
 
-        time.sleep(loop_time)
-        total_waited += loop_time
-        if total_waited > max_wait:
-            return loop_mtime
+            if (next_mtime := self.mtime()) != start_mtime:
+                return True, next_mtime
 
-    return next_mtime
+        return False, start_mtime
+
+
+def signal_wait(sig_name, prev_mtime=None, loop_time=1, max_wait=30):
+    """ wait for {sig_name}, returning the `.sig` file's mtime to pass in next time """
+    if sig_name not in waiters or waiters[sig_name].sock_file != socket_filename(sig_name, os.getpid()):
+        waiters[sig_name] = SignalWaiter(sig_name)
+    __, mtime = waiters[sig_name].wait(prev_mtime, max_wait, loop_time)
+    return mtime
 
 
 def main():
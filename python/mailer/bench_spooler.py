@@ -0,0 +1,188 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" spooler throughput benchmark, spool emails across all the templates in `emails/` & send them to an `SmtpSink`
+
+Runs in a scratch copy of $BASE, with its own spool, so no real email is touched or sent. Database
+writes (user messages & event log) are skipped, so only the spooler itself is measured """
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from librar import messages
+from librar.log import init as log_init
+from mailer import spool_email, run_spooler
+from mailer.smtp_sink import SmtpSink
+
+SCRATCH_ENV = "SPOOLER_BENCH_SCRATCH"
+WRITE_CHUNK = 500
+
+
+def make_scratch(backend):
+    """ scratch $BASE, sharing everything with the real one except `storage` & `policy.json` """
+    base = os.environ["BASE"]
+    scratch = tempfile.mkdtemp(prefix="bench_spooler_")
+    for file in os.listdir(base):
+        if file not in ("storage", "config"):
+            os.symlink(os.path.join(base, file), os.path.join(scratch, file))
+
+    os.mkdir(f"{scratch}/config")
+    for file in os.listdir(f"{base}/config"):
+        if file != "policy.json":
+            os.symlink(os.path.join(base, "config", file), os.path.join(scratch, "config", file))
+    bench_policy = {}
+    if os.path.isfile(f"{base}/config/policy.json"):
+        with open(f"{base}/config/policy.json", "r", encoding="utf-8") as fd:
+            bench_policy = json.load(fd)
+    bench_policy["spool_backend"] = backend
+    with open(f"{scratch}/config/policy.json", "w", encoding="utf-8") as fd:
+        json.dump(bench_policy, fd)
+
+    for spool_dir in ["spooler", "mail_error"]:
+        os.makedirs(f"{scratch}/storage/perm/{spool_dir}")
+    return scratch
+
+
+def template_names():
+    names = set()
+    for file in os.listdir(spool_email.TEMPLATE_DIR):
+        name, ext = os.path.splitext(file)
+        if ext in (".txt", ".html") and name not in ("start", "end"):
+            names.add(name)
+    return sorted(names)
+
+
+def sample_data(which_message, num):
+    """ records for email {num}, with every property the templates use """
+    name = f"bench-{num}.example"
+    domain = {
+        "domain_id": num,
+        "name": name,
+        "display_name": name,
+        "expiry_dt": "2030-01-01 00:00:00",
+        "new_expiry_dt": "2031-01-01 00:00:00"
+    }
+    order = {"order_type": "dom/renew", "price_paid_fmt": "10.00"}
+    registry = {"name": "bench", "expire_recover_limit": 30}
+    return {
+        "email": {
+            "message": which_message
+        },
+        "user": {
+            "user_id": num,
+            "name": f"Bench User {num}",
+            "email": f"user{num}@bench{num % 50}.example",
+            "email_verified": True,
+            "hash_confirm": "0" * 32,
+            "acct_current_balance_fmt": "10.00"
+        },
+        "domain": domain,
+        "registry": registry,
+        "order": order,
+        "sale": {
+            "sales_type": "dom/renew",
+            "num_years": 1,
+            "price_paid_fmt": "10.00"
+        },
+        "transaction": {
+            "amount_fmt": "10.00"
+        },
+        "items": [{
+            "domain": domain,
+            "order": order,
+            "registry": registry
+        }] * 3
+    }
+
+
+class Timer:
+    """ wrap {func} adding up the time spent in it """
+    def __init__(self, func):
+        self.func = func
+        self.secs = 0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.secs += time.perf_counter() - start
+
+
+def run_bench(args):
+    """ in the scratch $BASE, spool {args.emails} emails then send them all, return the results """
+    log_init(with_logging=False)
+    messages.send = lambda *args, **kwargs: None
+    spool_email.event_log = lambda *args, **kwargs: None
+
+    sink = SmtpSink(latency=args.latency, error_code=args.error_code, error_rate=args.error_rate).start()
+    names = template_names()
+
+    start = time.perf_counter()
+    for chunk in range(0, args.emails, WRITE_CHUNK):
+        last = min(chunk + WRITE_CHUNK, args.emails)
+        batch = [sample_data(names[num % len(names)], num) for num in range(chunk, last)]
+        for name in names:
+            if len(this_batch := [data for data in batch if data["email"]["message"] == name]) > 0:
+                spool_email.write_spooled(name, this_batch)
+    spool_secs = time.perf_counter() - start
+
+    run_spooler.spool_email_data = spool_timer = Timer(run_spooler.spool_email_data)
+    run_spooler.sessions.sendmail = send_timer = Timer(run_spooler.sessions.sendmail)
+
+    start = time.perf_counter()
+    while run_spooler.process_emails_waiting(f"127.0.0.1:{sink.port}")[0]:
+        pass
+    run_spooler.sessions.close()
+    total_secs = time.perf_counter() - start
+    sink.stop()
+
+    return {
+        "backend": args.backend,
+        "emails": args.emails,
+        "templates": len(names),
+        "spool_secs": round(spool_secs, 3),
+        "total_secs": round(total_secs, 3),
+        "per_sec": round(args.emails / total_secs, 1) if total_secs > 0 else None,
+        "render_secs": round(spool_timer.secs - send_timer.secs, 3),
+        "send_secs": round(send_timer.secs, 3),
+        "queue_secs": round(total_secs - spool_timer.secs, 3),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "sink": sink.stats
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Spooler throughput benchmark')
+    parser.add_argument("-n", '--emails', type=int, default=1000, help="Number of emails to spool & send")
+    parser.add_argument("-b", '--backend', default="files", choices=["files", "segments"])
+    parser.add_argument("-l", '--latency', type=float, default=0, help="Sink seconds to wait before replying to DATA")
+    parser.add_argument("-e", '--error-code', type=int, default=451, help="Sink reply code for rejected messages")
+    parser.add_argument("-r", '--error-rate', type=float, default=0, help="Share of messages the sink rejects")
+    parser.add_argument("-k", '--keep', action="store_true", help="Keep the scratch $BASE")
+    args = parser.parse_args()
+
+    if os.environ.get(SCRATCH_ENV) is not None:
+        print(json.dumps(run_bench(args), indent=3))
+        sys.exit(0)
+
+    # run again in the scratch $BASE, as paths are set from $BASE when modules are loaded
+    scratch = make_scratch(args.backend)
+    env = {**os.environ, "BASE": scratch, SCRATCH_ENV: "1"}
+    ret = subprocess.run([sys.executable, os.path.abspath(__file__)] + sys.argv[1:], env=env, check=False)
+    if args.keep:
+        print(f"Scratch $BASE kept in {scratch}")
+    else:
+        shutil.rmtree(scratch)
+    sys.exit(ret.returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" compiled email templates, kept for the life of the spooler & reloaded when `emails/` changes """
+
+import os
+import time
+import jinja2
+
+from librar.policy import this_policy as policy
+
+CHECK_EVERY = 5
+
+
+class EmailTemplates:
+    """ one jinja2 environment per process, compiled templates are cached in memory & their bytecode on disk """
+    def __init__(self, template_dir):
+        self.template_dir = template_dir
+        self.environment = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                                              auto_reload=False,
+                                              cache_size=-1,
+                                              bytecode_cache=jinja2.FileSystemBytecodeCache())
+        self.merge_files = {}
+        self.dir_mtime = None
+        self.next_check = 0
+        self.policy_data = None
+        self.policy_generation = None
+
+    def files_mtime(self):
+        latest = os.path.getmtime(self.template_dir)
+        for file in os.listdir(self.template_dir):
+            latest = max(latest, os.path.getmtime(os.path.join(self.template_dir, file)))
+        return latest
+
+    def check_for_changes(self):
+        """ at most every {CHECK_EVERY} secs, drop all compiled templates if any file in `emails/` has changed """
+        if time.monotonic() < self.next_check:
+            return
+        self.next_check = time.monotonic() + CHECK_EVERY
+        if (new_mtime := self.files_mtime()) != self.dir_mtime:
+            self.environment.cache.clear()
+            self.merge_files = {}
+            self.dir_mtime = new_mtime
+
+    def find(self, which_message):
+        """ return (template, is_html) for {which_message}, or None if there is no merge file """
+        self.check_for_changes()
+        if which_message not in self.merge_files:
+            self.merge_files[which_message] = None
+            for suffix, is_html in [("txt", False), ("html", True)]:
+                if os.path.isfile(f"{self.template_dir}/{which_message}.{suffix}"):
+                    template = self.environment.get_template(f"{which_message}.{suffix}")
+                    self.merge_files[which_message] = (template, is_html)
+                    break
+        return self.merge_files[which_message]
+
+    def policy_context(self):
+        """ policy values for the templates, only rebuilt when the policy file is reloaded """
+        policy.check_file()
+        if self.policy_generation != policy.generation:
+            self.policy_data = policy.data().copy()
+            self.policy_generation = policy.generation
+        return self.policy_data
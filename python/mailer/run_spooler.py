@@ -4,23 +4,29 @@
 
 import os
 import json
-import jinja2
 import time
-import smtplib
 import argparse
+import multiprocessing
 
 from librar.mysql import sql_server as sql
-from librar import registry, misc, policy, messages
+from librar import registry, misc, policy, messages, sigprocs
 from librar.log import log, init as log_init
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-from mailer import spool_email
+from mailer import spool_email, spool_queue, spool_segments
+from mailer.smtp_session import sessions
+from mailer.email_templates import EmailTemplates
+
+# drain both, so nothing is left behind when `spool_backend` is changed
+SPOOL_BACKENDS = [spool_segments, spool_queue]
 
 DO_NOT_INCLUDE_TAGS = {"X-Env-From", "BCC"}
 MULTILINE_TAGS = {"To", "CC", "BCC"}
 
+templates = EmailTemplates(spool_email.TEMPLATE_DIR)
+
 
 def spool_email_file(filename, server=None):
     with open(
@@ -29,29 +35,21 @@ def spool_email_file(filename, server=None):
             encoding="utf-8",
     ) as fd:
         data = json.load(fd)
+    return spool_email_data(data, server)
+
 
+def spool_email_data(data, server=None):
     if "email" not in data or "message" not in data["email"]:
         log("ERROR: no message type specified")
         return False, None
 
     which_message = data["email"]["message"]
-    pfx = f"{spool_email.TEMPLATE_DIR}/{which_message}"
-    merge_file = None
-    is_html = False
-    if os.path.isfile(f"{pfx}.txt"):
-        merge_file = f"{which_message}.txt"
-    elif os.path.isfile(f"{pfx}.html"):
-        merge_file = f"{which_message}.html"
-        is_html = True
-    else:
+    if (merge_file := templates.find(which_message)) is None:
         log(f"No merge message file found for '{which_message}'")
         return False, None
+    template, is_html = merge_file
 
-    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(f"{os.environ['BASE']}/emails"))
-    template = environment.get_template(merge_file)
-
-    data["policy"] = policy.policy_defaults
-    data["policy"].update(policy.this_policy.data())
+    data["policy"] = templates.policy_context()
 
     content = template.render(**data)
     header = {}
@@ -98,8 +96,9 @@ def spool_email_file(filename, server=None):
         data["state"] = "Not Verified"
         return True, data
 
+    opt_out_as = spool_email.DIGEST_OF.get(which_message, which_message)
     if ("user" in data and misc.has_data(data["user"], "email_opt_out")
-            and which_message in data["user"]["email_opt_out"].split(",")):
+            and opt_out_as in data["user"]["email_opt_out"].split(",")):
         data["state"] = "User Opt Out"
         return True, data
 
@@ -129,60 +128,109 @@ def spool_email_file(filename, server=None):
     if server is None:
         server = "127.0.0.1"
 
-    with smtplib.SMTP(server, 25) as smtp_cnx:
-        smtp_cnx.sendmail(smtp_from_addr, all_rcpt.split(","), msg.as_string())
-        smtp_cnx.quit()
-
+    sessions.sendmail(server, smtp_from_addr, all_rcpt.split(","), msg.as_string())
     return True, data
 
 
+def process_one(backend, item, server=None):
+    """ send one claimed email, moving it to the failed emails if that fails, False if its mail domain is busy """
+    records = None
+    domain = None
+    try:
+        data = backend.load(item)
+        if not spool_queue.domain_slots.take(domain := spool_queue.destination_domain(data)):
+            backend.unclaim(item)
+            return False
+        ok, records = spool_email_data(data, server)
+    except Exception as e:
+        log(f"ERROR: Exception running spool_email_file '{item}' - {type(e)}:{str(e)}")
+        ok = False
+    finally:
+        spool_queue.domain_slots.free(domain)
+
+    if ok:
+        if records is not None:
+            state = records["state"] if "state" in records else "Delivered"
+            spool_email.event_log(state, records)
+        backend.done(item)
+    else:
+        log(f"ERROR: Failed to process email '{item}'")
+        backend.failed(item)
+    return True
+
+
 def process_emails_waiting(server=None):
-    for file in os.listdir(spool_email.SPOOL_BASE):
-        path = os.path.join(spool_email.SPOOL_BASE, file)
-        if not os.path.isfile(path):
+    """ claim & send waiting emails, oldest first, return (sent any, any left because their mail domain was busy) """
+    sent_any = deferred_any = False
+    for backend in SPOOL_BACKENDS:
+        for item in backend.claim_waiting():
+            if process_one(backend, item, server):
+                sent_any = True
+            else:
+                deferred_any = True
+    return sent_any, deferred_any
+
+
+def run_server(server=None):
+    log(f"SMTP SPOOLER RUNNING as {os.getpid()}")
+    waiter = sigprocs.SignalWaiter("spooler")
+    signal_mtime = None
+    compacted = time.time()
+    while True:
+        sent_any, deferred_any = process_emails_waiting(server)
+        if sent_any:
             continue
+        registry.tld_lib.check_for_new_files()
+        sessions.close_idle()
+        if time.time() - compacted >= policy.this_policy.policy("spool_compact_interval"):
+            spool_segments.compact()
+            compacted = time.time()
+        max_wait = 1 if deferred_any else policy.this_policy.policy("spooler_max_wait")
+        __, signal_mtime = waiter.wait(signal_mtime, timeout=max_wait)
 
-        records = None
-        try:
-            ok, records = spool_email_file(path, server)
-        except Exception as e:
-            log(f"ERROR: Exception running spool_email_file '{path}' - {type(e)}:{str(e)}")
-            ok = False
-
-        if ok:
-            if records is not None:
-                state = records["state"] if "state" in records else "Delivered"
-                spool_email.event_log(state, records)
-            os.remove(path)
-        else:
-            log(f"ERROR: Failed to process email '{path}'")
-            os.replace(path, os.path.join(misc.make_year_month_day_dir(spool_email.ERROR_BASE), file))
 
+def start_up(debug):
+    log_init(with_debug=debug)
+    sql.connect("engine")
+    registry.start_up()
 
-def run_server():
-    log("SMTP SPOOLER RUNNING")
-    signal_mtime = None
+
+def run_worker(debug):
+    """ each worker process has its own database connection & SMTP sessions """
+    start_up(debug)
+    run_server()
+
+
+def run_workers(debug, num_workers):
+    """ run {num_workers} worker processes, restarting any that die & recovering their emails """
+    spool_queue.recover()
+    if num_workers <= 1:
+        return run_worker(debug)
+
+    log(f"SMTP SPOOLER STARTING {num_workers} WORKERS")
+    workers = []
     while True:
-        new_mtime = os.path.getmtime(spool_email.SPOOL_BASE)
-        if new_mtime == signal_mtime:
-            registry.tld_lib.check_for_new_files()
-            time.sleep(3)
-        else:
-            process_emails_waiting()
-            signal_mtime = new_mtime
+        if len(workers) != len(workers := [proc for proc in workers if proc.is_alive()]):
+            if spool_queue.recover():
+                sigprocs.signal_service("spooler")
+        while len(workers) < num_workers:
+            proc = multiprocessing.Process(target=run_worker, args=(debug, ), daemon=True)
+            proc.start()
+            workers.append(proc)
+        time.sleep(5)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='SMTP Spooler')
     parser.add_argument("-D", '--debug', action="store_true")
     parser.add_argument("-S", '--server')
+    parser.add_argument("-w", '--workers', type=int, help="Number of worker processes")
     args = parser.parse_args()
-    log_init(with_debug=args.debug)
-
-    sql.connect("engine")
-    registry.start_up()
 
     if args.server:
+        start_up(args.debug)
+        spool_queue.recover()
         process_emails_waiting(args.server)
+        sessions.close()
     else:
-        run_server()
+        run_workers(args.debug, args.workers if args.workers else policy.this_policy.policy("spooler_workers"))
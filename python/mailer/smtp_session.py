@@ -0,0 +1,115 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" long lived SMTP sessions, so the spooler can send many messages per connection """
+
+import time
+import smtplib
+
+from librar.log import log
+from librar.policy import this_policy as policy
+
+SMTP_PORT = 25
+
+
+class SmtpSession:
+    """ one SMTP connection, reconnected after `smtp_max_messages` messages, `smtp_idle_timeout` idle or an error """
+    def __init__(self, server, port=SMTP_PORT):
+        self.server = server
+        self.port = port
+        self.smtp_cnx = None
+        self.sent = 0
+        self.last_used = 0
+
+    def connect(self):
+        self.close()
+        self.smtp_cnx = smtplib.SMTP(self.server, self.port, timeout=policy.policy("smtp_timeout"))
+        self.smtp_cnx.ehlo()
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self.smtp_cnx is None:
+            return
+        try:
+            self.smtp_cnx.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp_cnx.close()
+        self.smtp_cnx = None
+
+    def drop(self):
+        """ close without QUIT, the connection is in an unknown state """
+        if self.smtp_cnx is None:
+            return
+        try:
+            self.smtp_cnx.close()
+        except OSError:
+            pass
+        self.smtp_cnx = None
+
+    def is_stale(self):
+        return (self.smtp_cnx is None or self.sent >= policy.policy("smtp_max_messages")
+                or time.monotonic() - self.last_used > policy.policy("smtp_idle_timeout"))
+
+    def sendmail(self, from_addr, rcpt_list, msg_str):
+        """ send one message, return the recipients the server refused, raise if none were accepted """
+        if self.is_stale():
+            self.connect()
+        try:
+            refused = self.try_sendmail(from_addr, rcpt_list, msg_str)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # server dropped an idle connection, worth one more go on a new one
+            self.connect()
+            refused = self.try_sendmail(from_addr, rcpt_list, msg_str)
+
+        if len(refused) > 0:
+            log(f"SMTP: {self.server} refused {', '.join(refused)}")
+        return refused
+
+    def try_sendmail(self, from_addr, rcpt_list, msg_str):
+        try:
+            refused = self.smtp_cnx.sendmail(from_addr, rcpt_list, msg_str)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # this message failed, but the session can carry on once it's reset
+            self.reset()
+            raise
+        except Exception:
+            # anything else may have left a transaction half done, so never reuse the connection
+            self.drop()
+            raise
+        self.sent += 1
+        self.last_used = time.monotonic()
+        return refused
+
+    def reset(self):
+        try:
+            self.smtp_cnx.rset()
+            self.last_used = time.monotonic()
+        except (smtplib.SMTPException, OSError):
+            self.close()
+
+
+class SmtpSessions:
+    """ one session per mail server, {server} can be `host:port` """
+    def __init__(self):
+        self.sessions = {}
+
+    def sendmail(self, server, from_addr, rcpt_list, msg_str):
+        if server not in self.sessions:
+            host, __, port = server.partition(":")
+            self.sessions[server] = SmtpSession(host, int(port) if port else SMTP_PORT)
+        return self.sessions[server].sendmail(from_addr, rcpt_list, msg_str)
+
+    def close_idle(self):
+        """ close sessions that have been idle too long, rather than leave them to time out at the server """
+        for session in self.sessions.values():
+            if session.smtp_cnx is not None and time.monotonic(
+            ) - session.last_used > policy.policy("smtp_idle_timeout"):
+                session.close()
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+
+sessions = SmtpSessions()
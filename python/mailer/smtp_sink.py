@@ -0,0 +1,130 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" local SMTP server that accepts & counts messages, without delivering them, for testing the spooler
+
+It can add latency to each message & fail a share of them, to act like a slow or unreliable mail server """
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import socketserver
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    """ one SMTP client connection """
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode("utf-8"))
+
+    def read_data(self):
+        """ read the message up to the `.` line, return its size """
+        size = 0
+        while (line := self.rfile.readline()) not in (b".\r\n", b".\n", b""):
+            size += len(line)
+        return size
+
+    def handle(self):
+        sink = self.server.sink
+        sink.count("connections")
+        self.reply("220 sink ESMTP")
+        rcpts = 0
+        while len(line := self.rfile.readline()) > 0:
+            verb = line[:4].decode("utf-8", errors="replace").upper()
+            if verb in ("HELO", "EHLO"):
+                self.reply("250 sink")
+            elif verb in ("MAIL", "RSET"):
+                rcpts = 0
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                rcpts += 1
+                self.reply("250 OK")
+            elif verb == "DATA":
+                if rcpts <= 0:
+                    self.reply("503 No recipients")
+                    continue
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                self.reply(sink.message(self.read_data(), rcpts))
+                rcpts = 0
+            elif verb == "NOOP":
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("500 Command not recognised")
+
+
+class SmtpSinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SmtpSink:
+    """ accept messages on {host}:{port}, port `0` picks a free one, see `port` once started """
+    def __init__(self, host="127.0.0.1", port=0, latency=0, error_code=451, error_rate=0):
+        self.server = SmtpSinkServer((host, port), SmtpSinkHandler)
+        self.server.sink = self
+        self.latency = latency
+        self.error_code = error_code
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.stats = {"connections": 0, "messages": 0, "recipients": 0, "bytes": 0, "rejected": 0}
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def message(self, size, rcpts):
+        """ a whole message has arrived, return the reply to send """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            self.count("rejected")
+            return f"{self.error_code} Sink rejected message"
+        with self.lock:
+            self.stats["messages"] += 1
+            self.stats["recipients"] += rcpts
+            self.stats["bytes"] += size
+        return "250 Queued"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SMTP sink, accepts & counts messages')
+    parser.add_argument("-H", '--host', default="127.0.0.1")
+    parser.add_argument("-p", '--port', type=int, default=2525)
+    parser.add_argument("-l", '--latency', type=float, default=0, help="Seconds to wait before replying to DATA")
+    parser.add_argument("-e", '--error-code', type=int, default=451, help="Reply code for rejected messages")
+    parser.add_argument("-r", '--error-rate', type=float, default=0, help="Share of messages to reject, 0 to 1")
+    args = parser.parse_args()
+
+    sink = SmtpSink(args.host, args.port, args.latency, args.error_code, args.error_rate).start()
+    print(f"SMTP sink listening on {args.host}:{sink.port}")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(sink.stats))
+    except KeyboardInterrupt:
+        sink.stop()
+    print(json.dumps(sink.stats))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,34 +14,110 @@ from librar.mysql import sql_server as sql
 from librar import registry
 from librar import misc
 from librar import hashstr
+from librar import sigprocs
+from mailer import spool_segments
 
 SPOOL_BASE = f"{os.environ['BASE']}/storage/perm/spooler"
 ERROR_BASE = f"{os.environ['BASE']}/storage/perm/mail_error"
 TEMPLATE_DIR = f"{os.environ['BASE']}/emails"
 
+# digest emails honour the user's opt-out of the email they replace
+DIGEST_OF = {"reminder_digest": "reminder", "payment_reminder_digest": "payment_reminder"}
+
 REQUIRE_FORMATTING = [
     "price_paid", "price_charged", "acct_current_balance", "amount", "pre_balance", "post_balance",
     "acct_current_balance", "acct_previous_balance", "acct_overdraw_limit", "acct_warn_low_balance", "for_sale_amount"
 ]
 
 
-def event_log(prefix, records):
+def event_item(prefix, records):
     email = records["user"]["email"] if "user" in records else None
     user_id = records["user"]["user_id"] if "user" in records else None
     domain_id = records["domain"]["domain_id"] if "domain" in records else None
     msg_type = records["email"]["message"] if "email" in records else None
-    mysql.event_log({
+    return {
         "event_type": f"{prefix}/{msg_type}",
         "domain_id": domain_id,
         "user_id": user_id,
         "who_did_it": "emailer",
         "from_where": "localhost",
         "notes": f"{prefix} message '{msg_type}' to '{email}'"
-    })
+    }
+
+
+def event_log(prefix, records):
+    mysql.event_log(event_item(prefix, records))
 
 
-def load_records(which_message, request_list):
+def format_record(table, reply):
+    """ add the derived properties templates use to a record loaded from {table} """
     my_currency = policy.policy("currency")
+    for fmt in REQUIRE_FORMATTING:
+        if fmt in reply and reply[fmt] is not None:
+            reply[fmt + "_fmt"] = misc.format_currency(reply[fmt], my_currency)
+
+    if table == "users":
+        reply["hash_confirm"] = hashstr.make_hash(reply["created_dt"] + ":" + reply["email"])
+
+    if table == "domains" and misc.has_data(reply, "name"):
+        if (idn := misc.puny_to_utf8(reply["name"])) is not None:
+            reply["display_name"] = idn
+        else:
+            reply["display_name"] = reply["name"]
+
+    return reply
+
+
+def single_key(where):
+    """ (column, value) if {where} is one column equal to one value, so can be loaded in bulk """
+    if isinstance(where, dict) and len(where) == 1:
+        col, val = next(iter(where.items()))
+        if isinstance(val, (int, str)):
+            return col, val
+    return None
+
+
+class RecordCache:
+    """ records loaded for many emails at once, so each is only loaded & formatted once """
+    def __init__(self):
+        self.records = {}
+
+    def preload(self, request_lists):
+        """ load every record {request_lists} need, with one `in (...)` query per table & column """
+        wanted = {}
+        for request_list in request_lists:
+            for request in request_list:
+                if request[0] is not None and (key := single_key(request[1])) is not None:
+                    if (request[0], key[0], key[1]) not in self.records:
+                        wanted.setdefault((request[0], key[0]), set()).add(key[1])
+
+        chunk_size = policy.policy("spool_bulk_chunk")
+        for (table, col), vals in wanted.items():
+            vals = list(vals)
+            for start in range(0, len(vals), chunk_size):
+                ok, reply = sql.sql_select(table, {col: vals[start:start + chunk_size]})
+                if not ok:
+                    continue
+                for row in reply:
+                    if (table, col, row[col]) not in self.records:
+                        self.records[(table, col, row[col])] = format_record(table, row)
+
+    def get(self, table, where):
+        if (key := single_key(where)) is not None and (table, key[0], key[1]) in self.records:
+            return True, self.records[(table, key[0], key[1])].copy()
+        ok, reply = sql.sql_select_one(table, where)
+        if not ok or len(reply) <= 0:
+            return False, None
+        reply = format_record(table, reply)
+        if key is not None:
+            self.records[(table, key[0], key[1])] = reply
+            reply = reply.copy()
+        return True, reply
+
+
+def load_records(which_message, request_list, cache=None):
+    if cache is None:
+        cache = RecordCache()
     return_data = {"email": {"message": which_message}}
     for request in request_list:
         table = request[0]
@@ -49,26 +125,15 @@ def load_records(which_message, request_list):
             return_data.update(request[1])
             continue
 
-        ok, reply = sql.sql_select_one(table, request[1])
+        ok, reply = cache.get(table, request[1])
 
-        if not ok or len(reply) <= 0:
+        if not ok:
             log(f"SPOOLER: Failed to load '{table}' where '{request[1]}'")
             return None
 
-        for fmt in REQUIRE_FORMATTING:
-            if fmt in reply and reply[fmt] is not None:
-                reply[fmt + "_fmt"] = misc.format_currency(reply[fmt], my_currency)
-
-        if table == "users":
-            reply["hash_confirm"] = hashstr.make_hash(reply["created_dt"] + ":" + reply["email"])
-
-        tag = request[3] if len(request) == 3 else table.rstrip("s")
+        tag = request[2] if len(request) == 3 else table.rstrip("s")
 
         if table == "domains" and misc.has_data(reply, "name"):
-            if (idn := misc.puny_to_utf8(reply["name"])) is not None:
-                reply["display_name"] = idn
-            else:
-                reply["display_name"] = reply["name"]
             return_data["registry"] = registry.tld_lib.reg_record_for_domain(reply["name"])
 
         return_data[tag] = reply
@@ -81,23 +146,64 @@ def load_records(which_message, request_list):
     return return_data
 
 
-def spool(which_message, request_list):
+def have_merge_file(which_message):
     pfx = f"{TEMPLATE_DIR}/{which_message}"
     if not os.path.isfile(f"{pfx}.txt") and not os.path.isfile(f"{pfx}.html"):
         log(f"Warning: No email merge file found for type '{which_message}'")
         return False
+    return True
 
-    if (request_data := load_records(which_message, request_list)) is None:
+
+def spool(which_message, request_list):
+    if not have_merge_file(which_message):
         return False
 
-    with tempfile.NamedTemporaryFile("w+", encoding="utf-8", dir=SPOOL_BASE, delete=False,
-                                     prefix=which_message + "_") as fd:
-        fd.write(json.dumps(request_data))
+    if (request_data := load_records(which_message, request_list)) is None:
+        return False
 
+    write_spooled(which_message, [request_data])
+    sigprocs.signal_service("spooler")
     event_log("Queued", request_data)
     return True
 
 
+def spool_many(which_message, request_lists):
+    """ spool {which_message} for each of {request_lists}, records are loaded in bulk, return number spooled """
+    if len(request_lists) <= 0 or not have_merge_file(which_message):
+        return 0
+
+    cache = RecordCache()
+    cache.preload(request_lists)
+
+    request_datas = []
+    for request_list in request_lists:
+        if (request_data := load_records(which_message, request_list, cache)) is not None:
+            request_datas.append(request_data)
+
+    if len(request_datas) > 0:
+        write_spooled(which_message, request_datas)
+        sigprocs.signal_service("spooler")
+        mysql.event_log_many([event_item("Queued", request_data) for request_data in request_datas])
+    return len(request_datas)
+
+
+def write_spooled(which_message, request_datas):
+    """ add {request_datas} to the spool, as one segment write, or a file each """
+    if policy.policy("spool_backend") == "segments":
+        spool_segments.append(request_datas)
+        return
+    for request_data in request_datas:
+        write_spool_file(which_message, request_data)
+
+
+def write_spool_file(which_message, request_data):
+    """ write with a leading `.` & rename once complete, so the spooler never sees half a file """
+    with tempfile.NamedTemporaryFile("w+", encoding="utf-8", dir=SPOOL_BASE, delete=False,
+                                     prefix="." + which_message + "_") as fd:
+        fd.write(json.dumps(request_data))
+    os.rename(fd.name, os.path.join(SPOOL_BASE, os.path.basename(fd.name)[1:]))
+
+
 def debug_formatter():
     def_cur = policy.policy("currency")
     cur = {
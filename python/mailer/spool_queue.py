@@ -0,0 +1,134 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" claim spooled emails so many spooler workers can share the spool directory
+
+A worker claims a file by renaming it into its own in-flight directory, so only one worker can get it.
+Files left in the in-flight directory of a worker that has died are put back in the spool """
+
+import os
+import re
+import json
+import fcntl
+import socket
+
+from librar.log import log
+from librar.policy import this_policy as policy
+from librar import misc
+from mailer.spool_email import SPOOL_BASE, ERROR_BASE
+
+INFLIGHT_BASE = f"{SPOOL_BASE}/.inflight"
+LOCKS_BASE = f"{SPOOL_BASE}/.locks"
+
+
+def worker_dir(pid=None):
+    return f"{INFLIGHT_BASE}/{socket.gethostname()}_{os.getpid() if pid is None else pid}"
+
+
+def waiting_files():
+    """ spooled files, oldest first, files starting `.` are still being written """
+    files = []
+    with os.scandir(SPOOL_BASE) as entries:
+        for entry in entries:
+            if entry.name[0] != "." and entry.is_file():
+                try:
+                    files.append((entry.stat().st_mtime, entry.name))
+                except FileNotFoundError:
+                    continue
+    return [file for __, file in sorted(files)]
+
+
+def claim(file):
+    """ move {file} into our in-flight dir, return its new path, or None if another worker got it first """
+    my_dir = worker_dir()
+    if not os.path.isdir(my_dir):
+        os.makedirs(my_dir, exist_ok=True)
+    path = os.path.join(my_dir, file)
+    try:
+        os.rename(os.path.join(SPOOL_BASE, file), path)
+    except FileNotFoundError:
+        return None
+    return path
+
+
+def claim_waiting():
+    """ claim each waiting file in turn, oldest first """
+    for file in waiting_files():
+        if (path := claim(file)) is not None:
+            yield path
+
+
+def unclaim(path):
+    """ put a claimed file back for another go """
+    os.replace(path, os.path.join(SPOOL_BASE, os.path.basename(path)))
+
+
+def done(path):
+    os.remove(path)
+
+
+def failed(path):
+    os.replace(path, os.path.join(misc.make_year_month_day_dir(ERROR_BASE), os.path.basename(path)))
+
+
+def load(path):
+    with open(path, "r", encoding="utf-8") as fd:
+        return json.load(fd)
+
+
+def recover():
+    """ put back files claimed by workers on this host that are no longer running """
+    if not os.path.isdir(INFLIGHT_BASE):
+        return 0
+    recovered = 0
+    host = socket.gethostname()
+    for name in os.listdir(INFLIGHT_BASE):
+        worker_host, __, pid = name.rpartition("_")
+        if worker_host != host or not pid.isdecimal() or misc.pid_alive(int(pid)):
+            continue
+        dead_dir = os.path.join(INFLIGHT_BASE, name)
+        for file in os.listdir(dead_dir):
+            unclaim(os.path.join(dead_dir, file))
+            recovered += 1
+        os.rmdir(dead_dir)
+    if recovered:
+        log(f"SPOOLER: Recovered {recovered} emails from stopped workers")
+    return recovered
+
+
+def destination_domain(data):
+    """ mail domain the email is going to, if we can tell before rendering it """
+    if "user" in data and misc.has_data(data["user"], "email") and data["user"]["email"].find("@") > 0:
+        return data["user"]["email"].split("@")[-1].lower()
+    return None
+
+
+class DomainSlots:
+    """ cap how many workers send to one mail domain at once, `flock` locks are dropped if a worker dies """
+    def __init__(self):
+        self.held = {}
+
+    def take(self, domain):
+        if domain is None or (limit := policy.policy("spooler_domain_limit")) is None:
+            return True
+        if not os.path.isdir(LOCKS_BASE):
+            os.makedirs(LOCKS_BASE, exist_ok=True)
+        lock_name = domain if re.fullmatch(r"[a-z0-9.-]+", domain) else misc.ashex(domain)
+        for slot in range(int(limit)):
+            lock_fd = os.open(f"{LOCKS_BASE}/{lock_name}.{slot}", os.O_CREAT | os.O_RDWR, 0o660)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(lock_fd)
+                continue
+            self.held[domain] = lock_fd
+            return True
+        return False
+
+    def free(self, domain):
+        if (lock_fd := self.held.pop(domain, None)) is not None:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+
+
+domain_slots = DomainSlots()
@@ -0,0 +1,400 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2023, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" spool emails into append-only segment files, instead of one file per email
+
+Each segment `seg_<n>.log` has one JSON email per line, found by its byte offset. Its `seg_<n>.idx` gets a
+fixed size entry each time an email is claimed, done, failed or released, the last entry for an offset is
+its state. Failed emails are copied to `failed.log`, so once every email in an old segment is done or failed
+the segment can be deleted """
+
+import os
+import sys
+import json
+import time
+import zlib
+import fcntl
+import struct
+import socket
+import argparse
+import contextlib
+
+from librar.log import log, init as log_init
+from librar.policy import this_policy as policy
+from librar import misc, sigprocs
+
+SEGMENTS_BASE = f"{os.environ['BASE']}/storage/perm/spooler/segments"
+FAILED_LOG = f"{SEGMENTS_BASE}/failed.log"
+WRITE_LOCK = f"{SEGMENTS_BASE}/.lock"
+
+STATE_CLAIMED = 1
+STATE_DONE = 2
+STATE_FAILED = 3
+STATE_RELEASED = 4
+FINISHED = (STATE_DONE, STATE_FAILED)
+
+# offset, state, host, pid, unix time
+IDX_ENTRY = struct.Struct("<QBIII")
+HOST_ID = zlib.crc32(socket.gethostname().encode("utf-8"))
+
+
+def open_owned(path, flags):
+    """ open {path}, if we are root & create it, give it to the owner of the spool, the `daemon` user """
+    out_fd = os.open(path, os.O_CREAT | flags, 0o660)
+    if os.geteuid() == 0:
+        spool_stat = os.stat(SEGMENTS_BASE)
+        os.fchown(out_fd, spool_stat.st_uid, spool_stat.st_gid)
+    return out_fd
+
+
+@contextlib.contextmanager
+def locked(path):
+    """ hold an exclusive `flock` on {path} for the life of the `with` """
+    lock_fd = open_owned(path, os.O_RDWR)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield lock_fd
+    finally:
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+
+def write_all(out_fd, data):
+    while len(data) > 0:
+        data = data[os.write(out_fd, data):]
+
+
+def fsync_dir(path):
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def segment_path(seq):
+    return f"{SEGMENTS_BASE}/seg_{seq:012d}"
+
+
+def segment_seqs():
+    """ sequence numbers of all segments, oldest first """
+    if not os.path.isdir(SEGMENTS_BASE):
+        return []
+    return sorted([
+        int(file[4:-4]) for file in os.listdir(SEGMENTS_BASE)
+        if file[:4] == "seg_" and file[-4:] == ".log" and file[4:-4].isdecimal()
+    ])
+
+
+def append_lines(path, data):
+    """ append {data} to {path} & fsync, starting a new line if a crashed writer left half of one """
+    out_fd = open_owned(path, os.O_RDWR | os.O_APPEND)
+    try:
+        if (size := os.lseek(out_fd, 0, os.SEEK_END)) > 0 and os.pread(out_fd, 1, size - 1) != b"\n":
+            data = b"\n" + data
+        write_all(out_fd, data)
+        os.fsync(out_fd)
+    finally:
+        os.close(out_fd)
+
+
+def append(request_datas):
+    """ add {request_datas} to the newest segment, with one write & one fsync for them all """
+    if len(request_datas) <= 0:
+        return 0
+    if not os.path.isdir(SEGMENTS_BASE):
+        os.makedirs(SEGMENTS_BASE, exist_ok=True)
+
+    data = "".join([json.dumps(request_data) + "\n" for request_data in request_datas]).encode("utf-8")
+    with locked(WRITE_LOCK):
+        seqs = segment_seqs()
+        seq = seqs[-1] if len(seqs) > 0 else 1
+        if len(seqs) > 0 and os.path.getsize(segment_path(seq) + ".log") >= policy.policy("spool_segment_size"):
+            seq += 1
+        new_segment = seq not in seqs
+        append_lines(segment_path(seq) + ".log", data)
+        if new_segment:
+            fsync_dir(SEGMENTS_BASE)
+    return len(request_datas)
+
+
+class Segment:
+    """ one segment, as far as this process has read it """
+    def __init__(self, seq):
+        self.seq = seq
+        self.path = segment_path(seq)
+        self.log_pos = 0
+        self.idx_pos = 0
+        self.lengths = {}
+        self.states = {}
+        self.unfinished = {}
+        self.idx_fd = None
+        self.dirty = False
+
+    def open_idx(self):
+        if self.idx_fd is None:
+            self.idx_fd = open_owned(self.path + ".idx", os.O_RDWR | os.O_APPEND)
+        return self.idx_fd
+
+    def close(self):
+        if self.idx_fd is not None:
+            os.close(self.idx_fd)
+            self.idx_fd = None
+
+    def refresh(self):
+        """ read any new emails & index entries, return False if the segment has gone """
+        try:
+            with open(self.path + ".log", "rb") as fd:
+                fd.seek(self.log_pos)
+                data = fd.read()
+        except FileNotFoundError:
+            return False
+
+        start = 0
+        while (end := data.find(b"\n", start)) >= 0:
+            offset = self.log_pos + start
+            self.lengths[offset] = end - start
+            if offset not in self.states or self.states[offset][0] not in FINISHED:
+                self.unfinished[offset] = True
+            start = end + 1
+        self.log_pos += start
+
+        idx_fd = self.open_idx()
+        data = os.pread(idx_fd, os.fstat(idx_fd).st_size - self.idx_pos, self.idx_pos)
+        for entry_pos in range(0, len(data) - IDX_ENTRY.size + 1, IDX_ENTRY.size):
+            offset, *entry = IDX_ENTRY.unpack_from(data, entry_pos)
+            self.states[offset] = entry
+            if entry[0] in FINISHED:
+                self.unfinished.pop(offset, None)
+        self.idx_pos += len(data) - (len(data) % IDX_ENTRY.size)
+        return True
+
+    def claimable(self, offset, now):
+        if (entry := self.states.get(offset)) is None or entry[0] == STATE_RELEASED:
+            return True
+        if entry[0] != STATE_CLAIMED:
+            return False
+        __, host, pid, when = entry
+        if host == HOST_ID and not misc.pid_alive(pid):
+            return True
+        return when + policy.policy("spool_claim_lease") < now
+
+    def mark(self, offsets, state):
+        now = int(time.time())
+        entries = b"".join([IDX_ENTRY.pack(offset, state, HOST_ID, os.getpid(), now) for offset in offsets])
+        write_all(self.open_idx(), entries)
+        for offset in offsets:
+            self.states[offset] = [state, HOST_ID, os.getpid(), now]
+            if state in FINISHED:
+                self.unfinished.pop(offset, None)
+        self.dirty = True
+
+    def sync(self):
+        if self.dirty and self.idx_fd is not None:
+            os.fsync(self.idx_fd)
+        self.dirty = False
+
+    def claim(self, limit, exclude):
+        """ claim up to {limit} waiting emails, the read & claim are atomic under the index lock """
+        if not os.path.isfile(self.path + ".log"):
+            return []
+        with locked(self.path + ".idx"):
+            if not self.refresh():
+                return []
+            now = time.time()
+            offsets = []
+            for offset in self.unfinished:
+                if offset not in exclude and self.claimable(offset, now):
+                    offsets.append(offset)
+                    if len(offsets) >= limit:
+                        break
+            if len(offsets) > 0:
+                self.mark(offsets, STATE_CLAIMED)
+        return [SpoolItem(self, offset) for offset in offsets]
+
+    def read(self, offset):
+        with open(self.path + ".log", "rb") as fd:
+            fd.seek(offset)
+            return fd.read(self.lengths[offset])
+
+    def finished(self):
+        return self.log_pos == os.path.getsize(self.path + ".log") and len(self.unfinished) == 0
+
+
+class SpoolItem:
+    """ one claimed email """
+    def __init__(self, segment, offset):
+        self.segment = segment
+        self.offset = offset
+
+    def __str__(self):
+        return f"seg_{self.segment.seq:012d}:{self.offset}"
+
+
+class SegmentQueue:
+    """ this process's view of all the segments """
+    def __init__(self):
+        self.segments = {}
+
+    def scan(self):
+        seqs = segment_seqs()
+        for seq in [seq for seq in self.segments if seq not in seqs]:
+            self.segments.pop(seq).close()
+        for seq in seqs:
+            if seq not in self.segments:
+                self.segments[seq] = Segment(seq)
+        return [self.segments[seq] for seq in seqs]
+
+    def claim(self, limit, exclude):
+        claimed = []
+        for segment in self.scan():
+            claimed += segment.claim(limit - len(claimed), exclude.get(segment.seq, set()))
+            if len(claimed) >= limit:
+                break
+        return claimed
+
+    def sync(self):
+        for segment in self.segments.values():
+            segment.sync()
+
+
+queue = SegmentQueue()
+
+
+def claim_waiting():
+    """ claim waiting emails, oldest first, a batch at a time, each email at most once per call """
+    exclude = {}
+    while len(items := queue.claim(policy.policy("spool_segment_claim"), exclude)) > 0:
+        for item in items:
+            exclude.setdefault(item.segment.seq, set()).add(item.offset)
+            yield item
+        queue.sync()
+
+
+def load(item):
+    return json.loads(item.segment.read(item.offset))
+
+
+def unclaim(item):
+    item.segment.mark([item.offset], STATE_RELEASED)
+
+
+def done(item):
+    item.segment.mark([item.offset], STATE_DONE)
+
+
+def failed(item):
+    """ keep a copy in `failed.log` for `--replay` before marking it failed """
+    with locked(FAILED_LOG + ".lock"):
+        append_lines(FAILED_LOG, item.segment.read(item.offset) + b"\n")
+    item.segment.mark([item.offset], STATE_FAILED)
+    item.segment.sync()
+
+
+def compact():
+    """ delete segments, except the newest, where every email is done or failed """
+    removed = 0
+    if not os.path.isdir(SEGMENTS_BASE):
+        return removed
+    with locked(WRITE_LOCK):
+        for seq in segment_seqs()[:-1]:
+            segment = Segment(seq)
+            with locked(segment.path + ".idx"):
+                if segment.refresh() and segment.finished():
+                    os.remove(segment.path + ".log")
+                    os.remove(segment.path + ".idx")
+                    removed += 1
+            segment.close()
+        for file in os.listdir(SEGMENTS_BASE):
+            if file[:4] == "seg_" and file[-4:] == ".idx" and not os.path.isfile(f"{SEGMENTS_BASE}/{file[:-4]}.log"):
+                os.remove(f"{SEGMENTS_BASE}/{file}")
+    if removed:
+        fsync_dir(SEGMENTS_BASE)
+        log(f"SPOOLER: Compacted {removed} spool segments")
+    return removed
+
+
+def segment_stats():
+    stats = {}
+    for seq in segment_seqs():
+        segment = Segment(seq)
+        if segment.refresh():
+            states = [segment.states[offset][0] if offset in segment.states else 0 for offset in segment.lengths]
+            stats[f"seg_{seq:012d}"] = {
+                "size": segment.log_pos,
+                "emails": len(segment.lengths),
+                "waiting": states.count(0) + states.count(STATE_RELEASED),
+                "claimed": states.count(STATE_CLAIMED),
+                "done": states.count(STATE_DONE),
+                "failed": states.count(STATE_FAILED)
+            }
+        segment.close()
+    return stats
+
+
+def failed_lines():
+    if not os.path.isfile(FAILED_LOG):
+        return []
+    with open(FAILED_LOG, "rb") as fd:
+        return [line for line in fd.read().split(b"\n") if len(line) > 0]
+
+
+def failed_summary(line):
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return {"error": "Invalid JSON", "line": line[:100].decode("utf-8", errors="replace")}
+    return {
+        "message": data["email"]["message"] if "email" in data and "message" in data["email"] else None,
+        "to": data["user"]["email"] if "user" in data and "email" in data["user"] else None,
+        "domain": data["domain"]["name"] if "domain" in data and "name" in data["domain"] else None
+    }
+
+
+def replay(match=None):
+    """ spool failed emails again, those with a message type of {match} or all, return number replayed """
+    with locked(FAILED_LOG + ".lock"):
+        replay_datas = []
+        keep = []
+        for line in failed_lines():
+            summary = failed_summary(line)
+            if "error" not in summary and (match is None or summary["message"] == match):
+                replay_datas.append(json.loads(line))
+            else:
+                keep.append(line)
+        if len(replay_datas) <= 0:
+            return 0
+        append(replay_datas)
+        with os.fdopen(open_owned(FAILED_LOG + ".tmp", os.O_WRONLY | os.O_TRUNC), "wb") as fd:
+            fd.write(b"".join([line + b"\n" for line in keep]))
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(FAILED_LOG + ".tmp", FAILED_LOG)
+    sigprocs.signal_service("spooler")
+    return len(replay_datas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Email spool segments')
+    parser.add_argument("-D", '--debug', action="store_true")
+    parser.add_argument("-l", '--list', action="store_true", help="Show what is in each segment")
+    parser.add_argument("-f", '--failed', action="store_true", help="Show failed emails")
+    parser.add_argument("-r", '--replay', action="store_true", help="Spool failed emails again")
+    parser.add_argument("-m", '--message', help="Only replay failed emails of this message type")
+    parser.add_argument("-c", '--compact', action="store_true", help="Delete segments that are finished")
+    args = parser.parse_args()
+    log_init(with_debug=args.debug)
+
+    if args.list:
+        print(json.dumps(segment_stats(), indent=3))
+    if args.failed:
+        print(json.dumps([failed_summary(line) for line in failed_lines()], indent=3))
+    if args.replay:
+        print("Replayed", replay(args.message))
+    if args.compact:
+        print("Removed", compact())
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,7 @@ from librar.mysql import sql_server as sql
 from librar import sigprocs, domobj, misc, pdns, tlsa, static, hashstr, registry, validate
 
 from mailer import spool_email
-from backend import libback
+from backend import libback, backend_creator
 
 
 def get_domain_prices(domlist, num_years=1, qry_type=None, user_id=None):
@@ -140,15 +140,7 @@ def check_update_ds(post_dom, dom_db, update_cols):
 def domain_backend_update(dom_db, request_type="dom/update"):
     if dom_db["status_id"] not in static.IS_LIVE_STATUS:
         return
-    bke_job = {
-        "domain_id": dom_db["domain_id"],
-        "user_id": dom_db["user_id"],
-        "job_type": request_type,
-        "execute_dt": misc.now(),
-        "created_dt": None
-    }
-    sql.sql_insert("backend", bke_job)
-    sigprocs.signal_service("backend")
+    backend_creator.make_job(request_type, dom_db)
 
 
 def domain_transfer(req):
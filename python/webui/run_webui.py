@@ -652,13 +652,10 @@ def pdns_action(func, action):
 
 def pdns_get_data(req, dom_db):
     dom_name = dom_db["name"]
-    pdns.create_zone(dom_name, ensure_zone=True)
-    domains.domain_backend_update(dom_db)
-    dns = pdns.load_zone(dom_name)
-
-    if dns and "dnssec" in dns and dns["dnssec"]:
-        dns["keys"] = pdns.load_zone_keys(dom_name)
-        dns["ds"] = pdns.find_best_ds(dns["keys"])
+    if (dns := pdns.zone_cache.load(dom_name)) is None:
+        pdns.create_zone(dom_name, ensure_zone=True)
+        domains.domain_backend_update(dom_db)
+        dns = pdns.zone_cache.load(dom_name)
 
     return req.response({"domain": dom_db, "dns": dns})
 
@@ -1,4 +1,4 @@
-grant insert,select on backend to webui
+grant insert,select,update on backend to webui
 grant insert,select on events to webui,engine
 grant insert,update,select on contacts to engine,webui
 grant insert,update,select on sales to webui